@@ -2,8 +2,15 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"ParseGFS": "1.ParseGFS.ipynb",
+index = {"DailyAggregator": "1.ParseGFS.ipynb",
+         "PrefetchPipeline": "1.ParseGFS.ipynb",
+         "StageManifest": "1.ParseGFS.ipynb",
+         "ParseGFS": "1.ParseGFS.ipynb",
+         "VariableCatalog": "2.ConvertToZarr.ipynb",
+         "ReferenceStore": "2.ConvertToZarr.ipynb",
          "ConvertToZarr": "2.ConvertToZarr.ipynb",
+         "StoreCache": "3.PrepMLData.ipynb",
+         "StratifiedSampler": "3.PrepMLData.ipynb",
          "PrepML": "3.PrepMLData.ipynb"}
 
 modules = ["parse_gfs.py",
@@ -1,13 +1,178 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: DataPipelineNotebooks/2.ConvertToZarr.ipynb (unless otherwise specified).
 
-__all__ = ['ConvertToZarr']
+__all__ = ['VariableCatalog', 'ReferenceStore', 'ConvertToZarr']
 
 # Cell
 import xarray as xr
 import zarr
+import netCDF4
+import numpy as np
+import dask.array as da
 from joblib import Parallel, delayed
 import pandas as pd
 import os
+import shutil
+import json
+import base64
+from collections.abc import Mapping
+import time
+from multiprocessing import Pool
+
+# Cell
+class VariableCatalog:
+    """
+    Persisted, ordered catalog of the variables of all the converted stores. The id of a variable is its position
+    in the catalog and never changes as new variables are only appended. For each season it records the ids of the
+    variables which are in every file of that season. Built by ConvertToZarr.build_catalog and saved as
+    VariableCatalog.json in the zarr folder, stores written with it have their variables in catalog order and
+    with ConvertToZarr variable_ids the catalog is the lookup table for their integer variable coordinate
+    """
+
+    def __init__(self, path):
+        """
+        Keyword Arguments
+        path: path of the json file, it is loaded if it already exists
+        """
+        self.path = path
+        self.variables = []
+        self.seasons = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                catalog = json.load(f)
+            self.variables = catalog['variables']
+            self.seasons = catalog['seasons']
+        self._ids = {v: i for i, v in enumerate(self.variables)}
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __len__(self):
+        return len(self.variables)
+
+    def add(self, season, variables_per_file):
+        """
+        Adds the variables of the files of a season, new variables are appended in the order they are first seen
+
+        Keyword Arguments
+        season: the season the files are from
+        variables_per_file: list with the list of variable names of each file of the season
+        """
+        common = None
+        for variables in variables_per_file:
+            for v in variables:
+                if v not in self._ids:
+                    self._ids[v] = len(self.variables)
+                    self.variables.append(v)
+            common = set(variables) if common is None else common & set(variables)
+        self.seasons[season] = sorted(self._ids[v] for v in (common or []))
+
+    def ids(self, names):
+        """
+        Returns the ids of a list of variable names as an int32 array
+
+        Keyword Arguments
+        names: list of variable names
+        """
+        return np.array([self._ids[n] for n in names], dtype='int32')
+
+    def names(self, ids):
+        """
+        Returns the variable names of a list of ids
+
+        Keyword Arguments
+        ids: list or array of variable ids
+        """
+        return [self.variables[i] for i in ids]
+
+    def decode(self, ds):
+        """
+        Returns ds with its integer variable coordinate replaced by the variable names
+
+        Keyword Arguments
+        ds: dataset or data array with an integer coded variable coordinate
+        """
+        return ds.assign_coords(variable=self.names(ds.variable.values))
+
+    def common(self, seasons):
+        """
+        Returns the names of the variables available in all of the seasons in catalog order
+
+        Keyword Arguments
+        seasons: list of seasons
+        """
+        ids = set.intersection(*[set(self.seasons[s]) for s in seasons])
+        return self.names(sorted(ids))
+
+    def save(self):
+        """
+        Writes the catalog, replacing the previous one in one step so it is never left half written
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'variables': self.variables, 'seasons': self.seasons}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+# Cell
+try:
+    from numcodecs import Shuffle
+except ImportError:
+    #older numcodecs don't have the HDF5 shuffle filter which compressed netCDF files use
+    from numcodecs.abc import Codec
+    from numcodecs.compat import ensure_contiguous_ndarray, ndarray_copy
+    from numcodecs.registry import register_codec
+
+    class Shuffle(Codec):
+        """
+        HDF5 byte shuffle filter, the bytes of the elements are grouped by their position in the element
+        """
+        codec_id = 'shuffle'
+
+        def __init__(self, elementsize=4):
+            self.elementsize = elementsize
+
+        def encode(self, buf):
+            buf = ensure_contiguous_ndarray(buf).view('u1')
+            return buf.reshape(-1, self.elementsize).T.tobytes()
+
+        def decode(self, buf, out=None):
+            buf = ensure_contiguous_ndarray(buf).view('u1')
+            return ndarray_copy(buf.reshape(self.elementsize, -1).T.copy(), out)
+
+    register_codec(Shuffle)
+
+# Cell
+class ReferenceStore(Mapping):
+    """
+    Read only zarr store over a reference file written by ConvertToZarr with zarr_layout='reference'
+    (the fsspec reference spec version 1 used by kerchunk). Each key is either inline data or the
+    [path, offset, size] byte range of a chunk in a netCDF file, so xr.open_zarr(ReferenceStore(path))
+    opens the netCDF files of a region and season as one lazy dataset without copying any data
+    """
+
+    def __init__(self, path):
+        """
+        Keyword Arguments
+        path: path of the json reference file
+        """
+        with open(path) as f:
+            self.refs = json.load(f)['refs']
+
+    def __getitem__(self, key):
+        ref = self.refs[key]
+        if isinstance(ref, str):
+            if ref.startswith('base64:'):
+                return base64.b64decode(ref[len('base64:'):])
+            return ref.encode()
+        path, offset, size = ref
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def __iter__(self):
+        return iter(self.refs)
+
+    def __len__(self):
+        return len(self.refs)
 
 # Cell
 class ConvertToZarr:
@@ -15,7 +180,14 @@ class ConvertToZarr:
     Class which encapsulates the logic to convert a set of filtered netCDF files to Zarr
     """
 
-    def __init__(self, seasons, regions, data_root, interpolate=1):
+    #chunk presets for the vars array (-1 is the whole dimension)
+    #legacy is one chunk per day and grid cell, lookback keeps a full season (182 days for leap years)
+    #of a grid cell in one chunk so a lookback window for a training sample is a single chunk read
+    #cell is only used by stores written with valid_cells_only or the season zarr_layout
+    CHUNK_PRESETS = {'legacy': {'time':1, 'latitude':1, 'longitude':1, 'cell':1, 'variable':-1},
+                     'lookback': {'time':182, 'latitude':1, 'longitude':1, 'cell':1, 'variable':-1}}
+
+    def __init__(self, seasons, regions, data_root, interpolate=1, input_layout='region', chunks='legacy', dtype=None, compressor='source', batch_days=30, zarr_layout='region', valid_cells_only=False, variable_catalog=False, variable_ids=False):
         """
         Initialize the class
 
@@ -24,6 +196,19 @@ class ConvertToZarr:
         regions: dictonary of Key: State and Value: List of Regions to process for that state
         data_root: the root path of the data folders which contains the 3.GFSFiltered1xInterpolation
         interpolate: the amount of interpolation applied in in the previous ParseGFS notebook (used for finding the correct input/output paths)
+        input_layout: the output_layout used in ParseGFS, 'region' for Region_<name>_<date>.nc files or 'day' for Regions_<date>.nc files with a group per region (default 'region')
+        chunks: name of a CHUNK_PRESETS entry or a dictionary of dimension to chunk size for the vars array (default 'legacy')
+        dtype: dtype to store vars as, None keeps the dtype of the netCDF files (default None)
+        compressor: compressor used by rechunk_local, None for no compression or 'source' to keep the current one (default 'source')
+        batch_days: number of days compute_region buffers in memory for each write (default 30)
+        zarr_layout: 'region' for a Region_<name>.zarr store per region or 'season' for a single <state>.zarr store per season
+                     with the grid cells of all the regions stacked along a cell dimension or 'reference' for a Region_<name>.json reference file
+                     per region which opens as a virtual zarr store over the netCDF files instead of converting them, see compute_region_references (default 'region')
+        valid_cells_only: only store the grid cells of a region which have data (the ones inside the region polygon) along a cell dimension
+                          instead of the full latitude/longitude grid, see stack_cells (default False)
+        variable_catalog: build a VariableCatalog of all the seasons before converting and write every new store with all
+                          the variables of the catalog in catalog order, variables missing from a file are NaN (default False)
+        variable_ids: store the variable coordinate as the int32 ids of the VariableCatalog instead of the names, requires variable_catalog (default False)
         """
         self.processed_path = data_root + '/3.GFSFiltered'+ str(interpolate) + 'xInterpolation/'
         self.zarr_base_path = data_root + '/4.GFSFiltered'+ str(interpolate) + 'xInterpolationZarr/'
@@ -31,13 +216,54 @@ class ConvertToZarr:
         self.seasons = seasons
         self.regions = regions
         self.data_root = data_root
+        assert(input_layout in ['region', 'day'])
+        self.input_layout = input_layout
+        self.chunks = ConvertToZarr.resolve_chunks(chunks)
+        self.dtype = dtype
+        self.compressor = compressor
+        self.batch_days = batch_days
+        assert(zarr_layout in ['region', 'season', 'reference'])
+        self.zarr_layout = zarr_layout
+        #references point at the netCDF data as it is so the cells and variable coordinate can't be changed
+        assert(zarr_layout != 'reference' or not (valid_cells_only or variable_ids))
+        self.valid_cells_only = valid_cells_only
 
         if not os.path.exists(self.zarr_base_path):
             os.makedirs(self.zarr_base_path)
 
+        assert(variable_catalog or not variable_ids)
+        self.variable_ids = variable_ids
+        self.catalog = None
+        if variable_catalog:
+            self.catalog = VariableCatalog(self.zarr_base_path + 'VariableCatalog.json')
+
     def compute_region(self, region_name, season, state):
         """
-        Calculates the zarr conversion for a specific region, season and state and indexes it for efficient lookup
+        Calculates the zarr conversion for a specific region, season and state and indexes it for efficient lookup.
+        The days in the store are recorded in its completion marker (see write_days_written) so a rerun only
+        checks the marker of a complete store and resumes an incomplete one after its last day, missing days
+        before its last day are inserted (see insert_region_days)
+
+        Keyword Arguments
+        region_name: name of the region to process
+        season: season to process
+        state: state to process (region must be a part of the state)
+        """
+        writer = self.region_writer(region_name, season, state)
+        if writer is None:
+            return
+
+        dates, add, finish = writer
+        for d in dates:
+            if not add(self.open_region_day(region_name, season, d)):
+                return
+        finish()
+
+    def region_writer(self, region_name, season, state):
+        """
+        Prepares the conversion of a region store for compute_region and compute_state, returns None if the store is complete
+        otherwise (dates, add, finish): dates are the days left to convert, add(ds) takes the loaded data of the next of those days
+        (None if it is missing) and returns False if a write failed and finish() writes the days still buffered and consolidates the metadata
 
         Keyword Arguments
         region_name: name of the region to process
@@ -45,79 +271,1004 @@ class ConvertToZarr:
         state: state to process (region must be a part of the state)
         """
         first = True
-        base_path = self.processed_path + season + '/' + '/Region_' + region_name
         zarr_path = self.zarr_base_path + season + '/' + state + '/Region_' + region_name + '.zarr'
+        valid = None
+        store_end = None
+
+        date_values_pd = ConvertToZarr.season_dates(season)
+        season_days = date_values_pd
+        written = np.zeros(len(season_days), dtype=bool)
+        try:
+            #the marker is rewritten from the time coordinate when it can't be trusted (see days_in_store)
+            marker = ConvertToZarr.read_days_written(zarr_path, season_days)
+            written = season_days.isin(ConvertToZarr.days_in_store(zarr_path, season_days))
+            if marker is None or (marker != written).any():
+                ConvertToZarr.write_days_written(zarr_path, season_days, written)
+                zarr.consolidate_metadata(zarr_path)
+
+            last = np.flatnonzero(written)[-1] if written.any() else -1
+            gaps = season_days[:max(last, 0)][~written[:max(last, 0)]]
+            if written[-1] and len(gaps) == 0:
+                print(' already exists: ' + region_name + ' ' + season + ' ' + state)
+                return None
+            else:
+                #already exists but incomplete, days after the last day in the store are appended and the ones before it are inserted
+                if len(gaps) > 0:
+                    print(' ' + str(len(gaps)) + ' missing days before the last day in the store are inserted: ' + region_name + ' ' + season + ' ' + state)
+                    store_end = season_days[last]
+                date_values_pd = gaps.append(season_days[last + 1:])
+                print(' some exist but have to complete ' + str(len(date_values_pd)))
+                first = False
+                with xr.open_zarr(zarr_path) as z:
+                    final_vars = list(z.variable.values)
+                    if z.variable.dtype.kind in 'iu':
+                        final_vars = self.catalog.names(final_vars)
+                    if 'cell_index' in z.coords:
+                        valid = z.cell_index.values
+        except (ValueError, KeyError) as err:
+            #ignore as it doesn't exist yet
+            pass
+
+        #sometimes vars get added, filter to only the list of vars in the first dataset for that region
+        #or with the catalog align every day to the catalog so no variable is dropped
+        if first:
+            final_vars = self.catalog_variables(season)
+
+        #days are buffered and written batch_days at a time (rounded up to whole time chunks) so the array
+        #is only resized and written once per batch and the metadata is only consolidated once at the end
+        time_chunk = self.chunks['time']
+        if time_chunk == -1:
+            batch_days = len(date_values_pd)
+        else:
+            batch_days = -(-self.batch_days // time_chunk) * time_chunk
+
+        def write_days(days, create):
+            try:
+                ConvertToZarr.append_region_day(xr.concat(days, dim='time'), zarr_path, None if create else final_vars,
+                                                self.chunks, self.dtype, consolidated=False,
+                                                catalog=self.catalog if self.variable_ids else None)
+            except ValueError as err:
+                print('Value Error ' + format(err) + ' on ' + zarr_path )
+                return False
+            #the marker is updated after every batch so an interrupted run resumes after the last batch written
+            written[season_days.get_indexer([day.time.values[0] for day in days])] = True
+            ConvertToZarr.write_days_written(zarr_path, season_days, written)
+            return True
 
+        days = []
+        gap_days = []
+        keep = None
+
+        def add(ds):
+            nonlocal first, final_vars, valid, days, keep
+            if ds is None:
+                return True
+
+            if final_vars is None:
+                final_vars = list(ds.data_vars)
+            if self.valid_cells_only:
+                #the polygon mask is the same every day so the valid cells are taken from the first day
+                if valid is None:
+                    valid = ConvertToZarr.valid_cells(ds)
+                ds = ConvertToZarr.stack_cells(ds, valid)
+            if self.catalog is not None:
+                ds = ds.to_array().reindex(variable=final_vars).to_dataset(dim='variable')
+            else:
+                if keep is None:
+                    keep = set(final_vars)
+                ds = ds[[v for v in ds.data_vars if v in keep]]
+            if store_end is not None and ds.time.values[0] < store_end:
+                #each insert rewrites the store so the missing days are inserted together in finish
+                gap_days.append(ds)
+                return True
+            days.append(ds)
+
+            if len(days) == batch_days:
+                if not write_days(days, first):
+                    return False
+                first = False
+                days = []
+            return True
+
+        def finish():
+            if len(days) > 0 and not write_days(days, first):
+                return
+            if len(gap_days) > 0:
+                try:
+                    ConvertToZarr.insert_region_days(xr.concat(gap_days, dim='time'), zarr_path, final_vars,
+                                                     self.catalog if self.variable_ids else None)
+                except ValueError as err:
+                    print('Value Error ' + format(err) + ' on ' + zarr_path)
+                    return
+                written[season_days.get_indexer([day.time.values[0] for day in gap_days])] = True
+                ConvertToZarr.write_days_written(zarr_path, season_days, written)
+
+            #also consolidates a store left unconsolidated by an interrupted run
+            if os.path.exists(zarr_path):
+                zarr.consolidate_metadata(zarr_path)
+
+        return date_values_pd, add, finish
+
+    def compute_state(self, region_names, season, state):
+        """
+        Converts regions of a state and season in one pass over the days for the 'day' input_layout, each Regions_<date>.nc file
+        is opened once and its groups are handed to all the regions instead of reopening the file for every region.
+        Each region still resumes from its own completion marker (see region_writer, region_season_writer and compute_references),
+        as every region buffers its own batch the memory used is batch_days of the whole state
+
+        Keyword Arguments
+        region_names: names of the regions to process
+        season: season to process
+        state: state to process (regions must be a part of the state)
+        """
+        if self.zarr_layout == 'reference':
+            self.compute_references(region_names, season, state)
+            return
+
+        writers = {}
+        for region_name in region_names:
+            if self.zarr_layout == 'season':
+                writer = self.region_season_writer(region_name, season, state)
+            else:
+                writer = self.region_writer(region_name, season, state)
+            if writer is not None:
+                writers[region_name] = writer
+
+        for d in sorted(set(d for dates, add, finish in writers.values() for d in dates)):
+            regions = [r for r in writers.keys() if d in writers[r][0]]
+            day = self.load_day_regions(season, d, [self.region_day_path(r, season, d)[1] for r in regions])
+            for region_name in regions:
+                #a region whose write failed is left for the next run like compute_region
+                if not writers[region_name][1](day.get(self.region_day_path(region_name, season, d)[1])):
+                    del writers[region_name]
+
+        for dates, add, finish in writers.values():
+            finish()
+
+    @staticmethod
+    def season_dates(season):
+        """
+        Returns the daily dates of a season, November 1 through April 30
+
+        Keyword Arguments
+        season: season in the form '18-19'
+        """
         #TODO: refactor these to be shared code as logic also exists in ParseGFS
         p = 181
-        if season in ['15-16', '19-20']:
+        if (2000 + int(season[3:])) % 4 == 0:
             p = 182 #leap years
+        return pd.date_range('20' + season[:2] + '-11-01', periods=p, freq="D")
+
+    @staticmethod
+    def read_days_written(zarr_path, date_values_pd, group=None):
+        """
+        Returns a boolean array of which days of date_values_pd the completion marker of a store records as written
+        (see write_days_written) or None if there is no marker for date_values_pd.
+        Only the zarr attributes are read so deciding what is left to do doesn't open the dataset
 
-        snow_start_date = '2015-11-01'
-        if season == '16-17':
-            snow_start_date = '2016-11-01'
-        if season == '17-18':
-            snow_start_date = '2017-11-01'
-        if season == '18-19':
-            snow_start_date = '2018-11-01'
-        if season == '19-20':
-            snow_start_date = '2019-11-01'
-
-        date_values_pd = pd.date_range(snow_start_date, periods=p, freq="D")
+        Keyword Arguments
+        zarr_path: path of the zarr store
+        date_values_pd: the daily dates of the season
+        group: group holding the marker, None for the root of the store (default None)
+        """
         try:
-            with xr.open_zarr(zarr_path) as z:
-                if z.time.values[-1] == date_values_pd[-1]:
-                    print(' already exists: ' + region_name + ' ' + season + ' ' + state)
-                    z.close()
-                    return
+            attrs = zarr.open_group(zarr_path, mode='r', path=group).attrs.asdict()
+        except ValueError:
+            #no store or no marker group yet
+            return None
+        if attrs.get('days_start') != date_values_pd[0].strftime('%Y-%m-%d') or len(attrs.get('days_written', '')) != len(date_values_pd):
+            return None
+        return np.array([c == '1' for c in attrs['days_written']])
+
+    @staticmethod
+    def write_days_written(zarr_path, date_values_pd, written, group=None):
+        """
+        Records the completion marker of a store in its zarr attributes, days_start is the first day of date_values_pd
+        and days_written has a '1' for every day which is in the store and a '0' for every day which isn't
+
+        Keyword Arguments
+        zarr_path: path of the zarr store
+        date_values_pd: the daily dates of the season
+        written: boolean array of the days of date_values_pd which are in the store
+        group: group to hold the marker, created if needed, None for the root of the store (default None)
+        """
+        zarr.open_group(zarr_path, mode='a', path=group).attrs.update({'days_start': date_values_pd[0].strftime('%Y-%m-%d'),
+                                                                       'days_written': ''.join('1' if w else '0' for w in written)})
+
+    @staticmethod
+    def days_in_store(zarr_path, date_values_pd):
+        """
+        Returns the days in a region store, from its completion marker when the marker agrees with the length of the time coordinate
+        (only the zarr attributes are read) otherwise from the time coordinate, e.g. for stores without a marker or with out of season days
+
+        Keyword Arguments
+        zarr_path: path of the region zarr store
+        date_values_pd: the daily dates of the season
+        """
+        marker = ConvertToZarr.read_days_written(zarr_path, date_values_pd)
+        if marker is not None and marker.sum() == zarr.open_group(zarr_path, mode='r')['time'].shape[0]:
+            return date_values_pd[marker]
+        with xr.open_zarr(zarr_path) as z:
+            return pd.DatetimeIndex(z.time.values)
+
+    @staticmethod
+    def region_group(region_name):
+        """
+        Returns the netCDF group name used for a region in the 'day' layout (group names can't contain /)
+
+        Keyword Arguments
+        region_name: name of the region
+        """
+        return region_name.replace('/', '_')
+
+    @staticmethod
+    def open_day_regions(path, chunks=None):
+        """
+        Reader for the 'day' layout, returns a dictionary of region group name to a dataset for that region.
+        The file is opened once and shared by the datasets, they are lazy so only the regions which are used get read
+        and closing any of them closes the file (it is reopened if one of the others is read after that)
+
+        Keyword Arguments
+        path: path to a Regions_<date>.nc file
+        chunks: passed to xr.open_dataset (default None)
+        """
+        manager = xr.backends.CachingFileManager(netCDF4.Dataset, path, mode='r')
+        try:
+            groups = list(manager.acquire().groups.keys())
+        except OSError:
+            manager.close()
+            raise
+        return {g: xr.open_dataset(xr.backends.NetCDF4DataStore(manager, group=g), chunks=chunks) for g in groups}
+
+    def region_day_path(self, region_name, season, d):
+        """
+        Returns the path and group of the filtered netCDF data of a region for a single day
+
+        Keyword Arguments
+        region_name: name of the region
+        season: season the day is in
+        d: the day as a pandas Timestamp
+        """
+        if self.input_layout == 'day':
+            #one file per day with a group for each region
+            return self.processed_path + season + '/Regions_' + d.strftime('%Y%m%d') + '.nc', ConvertToZarr.region_group(region_name)
+        return self.processed_path + season + '/' + '/Region_' + region_name + '_' + d.strftime('%Y%m%d') + '.nc', None
+
+    def build_catalog(self):
+        """
+        Adds the seasons which aren't in the VariableCatalog yet to it and saves it,
+        only the variable names are read from the netCDF files
+        """
+        for season in self.seasons:
+            if season in self.catalog.seasons:
+                continue
+            print('Cataloging variables of ' + season)
+            variables_per_file = []
+            for d in ConvertToZarr.season_dates(season):
+                if self.input_layout == 'day':
+                    variables_per_file += self.day_variables(season, d)
+                    continue
+                for state in self.regions.keys():
+                    for region_name in self.regions[state]:
+                        path, group = self.region_day_path(region_name, season, d)
+                        try:
+                            with xr.open_dataset(path, group=group) as ds:
+                                variables_per_file.append(list(ds.data_vars))
+                        except OSError as err:
+                            continue
+            if len(variables_per_file) == 0:
+                #not recorded so the season is cataloged once its files are there
+                print(' no netCDF files for: ' + season)
+                continue
+            self.catalog.add(season, variables_per_file)
+        self.catalog.save()
+
+    def catalog_variables(self, season):
+        """
+        Returns the variables of the VariableCatalog to write the stores of a season with, None without variable_catalog.
+        The catalog is built first if it doesn't have the season yet so the compute methods can also be run without convert_local
+
+        Keyword Arguments
+        season: season being converted
+        """
+        if self.catalog is None:
+            return None
+        if season not in self.catalog.seasons:
+            self.build_catalog()
+        if len(self.catalog) == 0:
+            raise ValueError('The variable catalog ' + self.catalog.path + ' is empty, no netCDF files were found for ' + season)
+        return self.catalog.variables
+
+    def day_variables(self, season, d):
+        """
+        Returns the list of variable names of each region group of a Regions_<date>.nc file of the 'day' input_layout,
+        the file is opened once for all the regions and only the metadata is read
+
+        Keyword Arguments
+        season: season the day is in
+        d: the day as a pandas Timestamp
+        """
+        groups = [self.region_day_path(r, season, d)[1] for state in self.regions.keys() for r in self.regions[state]]
+        try:
+            day = ConvertToZarr.open_day_regions(self.processed_path + season + '/Regions_' + d.strftime('%Y%m%d') + '.nc')
+        except OSError as err:
+            return []
+        variables = [list(day[g].data_vars) for g in groups if g in day]
+        for ds in day.values():
+            ds.close()
+        return variables
+
+    def open_region_day(self, region_name, season, d):
+        """
+        Loads the filtered netCDF data of a region for a single day, returns None if the file is missing
+
+        Keyword Arguments
+        region_name: name of the region to load
+        season: season the day is in
+        d: the day to load as a pandas Timestamp
+        """
+        path, group = self.region_day_path(region_name, season, d)
+        print('On ' + str(path.split('/')[-1]))
+
+        try:
+            with xr.open_dataset(path, group=group) as ds:
+                return ds.load()
+        except OSError as err:
+            print(' missing file: ' + path)
+            return None
+
+    def load_day_regions(self, season, d, groups=None):
+        """
+        Loads the groups of a Regions_<date>.nc file of the 'day' input_layout with one open of the file (see open_day_regions),
+        returns a dictionary of group name to the loaded dataset which is empty if the file is missing
+
+        Keyword Arguments
+        season: season the day is in
+        d: the day to load as a pandas Timestamp
+        groups: names of the groups to load, None loads all of them (default None)
+        """
+        path = self.processed_path + season + '/Regions_' + d.strftime('%Y%m%d') + '.nc'
+        print('On ' + str(path.split('/')[-1]))
+
+        try:
+            day = ConvertToZarr.open_day_regions(path)
+        except OSError as err:
+            print(' missing file: ' + path)
+            return {}
+
+        try:
+            return {g: ds.load() for g, ds in day.items() if groups is None or g in groups}
+        finally:
+            for ds in day.values():
+                ds.close()
+
+    @staticmethod
+    def valid_cells(ds):
+        """
+        Returns the index of the cells in the row-major latitude/longitude grid of ds with at least one non-NaN value,
+        cells outside of the region polygon are NaN for every variable
+
+        Keyword Arguments
+        ds: dataset of a region with latitude and longitude dimensions
+        """
+        values = ds.to_array().transpose(..., 'latitude', 'longitude').values
+        values = values.reshape(-1, values.shape[-2] * values.shape[-1])
+        return np.flatnonzero(~np.isnan(values).all(axis=0))
+
+    @staticmethod
+    def stack_cells(ds, cells=None):
+        """
+        Flattens the latitude/longitude grid of ds to a cell dimension with latitude and longitude coordinates per cell
+        and a cell_index coordinate, the validity index, which is the position of the cell in the row-major grid
+
+        Keyword Arguments
+        ds: dataset of a region with latitude and longitude dimensions
+        cells: index of the cells to keep, e.g. from valid_cells, None keeps all of them (default None)
+        """
+        ds = ds.stack(cell=('latitude', 'longitude'))
+        ds = ds.assign_coords(cell_index=('cell', np.arange(ds.dims['cell'])))
+        if cells is not None:
+            ds = ds.isel(cell=cells)
+        return ds.reset_index('cell')
+
+    def season_store_path(self, season, state):
+        """
+        Returns the path of the single store of a season and state used by the 'season' zarr_layout
+
+        Keyword Arguments
+        season: season of the store
+        state: state of the store
+        """
+        return self.zarr_base_path + season + '/' + state + '.zarr'
+
+    def create_season_store(self, season, state):
+        """
+        Preallocates the single store for a season and state so the regions can then be written to it in parallel by compute_region_season.
+        vars has the dims (variable, time, cell) where cell is the stacked latitude/longitude grid of every region in the state,
+        each cell has region, latitude, longitude and cell_index (see stack_cells) coordinates and the regions and region_offsets attributes give the
+        cell range [region_offsets[i], region_offsets[i+1]) of regions[i].
+        The grid of each region (only its valid cells with valid_cells_only) and the variables of the store are taken from the first available day,
+        nothing is written for vars so days that are never written read as NaN
+
+        Keyword Arguments
+        season: season to create the store for
+        state: state to create the store for
+        """
+        zarr_path = self.season_store_path(season, state)
+        if os.path.exists(zarr_path):
+            print(' already exists: ' + zarr_path)
+            return
+
+        date_values_pd = ConvertToZarr.season_dates(season)
+        final_vars = None
+        dtype = self.dtype
+        regions = []
+        offsets = [0]
+        cells = []
+        day_regions = {}
+        for region_name in self.regions[state]:
+            ds = None
+            for d in date_values_pd:
+                if self.input_layout == 'day':
+                    #the regions usually start on the same day so each day file is only loaded once
+                    if d not in day_regions:
+                        day_regions[d] = self.load_day_regions(season, d)
+                    ds = day_regions[d].get(self.region_day_path(region_name, season, d)[1])
                 else:
-                    #already exists but incomplete
-                    date_values_pd = [pd.Timestamp(v) for v in date_values_pd.values.astype('datetime64[ns]') if v not in z.time.values]
-                    print(' some exist but have to complete ' + str(len(date_values_pd)))
-                    first = False
-        except ValueError as err:
-            #ignore as it doesn't exist yet
+                    ds = self.open_region_day(region_name, season, d)
+                if ds is not None:
+                    break
+            if ds is None:
+                print(' no data for: ' + region_name + ' ' + season + ' ' + state)
+                continue
+
+            if final_vars is None:
+                final_vars = list(ds.data_vars) if self.catalog is None else self.catalog_variables(season)
+                if dtype is None:
+                    dtype = ds[list(ds.data_vars)[0]].dtype
+            grid = ConvertToZarr.stack_cells(ds, ConvertToZarr.valid_cells(ds) if self.valid_cells_only else None)
+            cells.append(pd.DataFrame({'region': region_name,
+                                       'latitude': grid.latitude.values,
+                                       'longitude': grid.longitude.values,
+                                       'cell_index': grid.cell_index.values}))
+            regions.append(region_name)
+            offsets.append(offsets[-1] + grid.dims['cell'])
+
+        if final_vars is None:
+            return
+        cells = pd.concat(cells)
+
+        #one cell per chunk keeps the regions in disjoint chunks so they can be written without locks
+        zarr_chunks = tuple(n if self.chunks[d] == -1 else self.chunks[d]
+                            for d, n in [('variable', len(final_vars)), ('time', len(date_values_pd))]) + (1,)
+        shape = (len(final_vars), len(date_values_pd), len(cells))
+        ds = xr.Dataset({'vars': (('variable', 'time', 'cell'), da.full(shape, np.nan, dtype=dtype, chunks=zarr_chunks))},
+                        coords={'variable': self.catalog.ids(final_vars) if self.variable_ids else final_vars,
+                                'time': date_values_pd,
+                                'region': ('cell', np.asarray(cells['region'], dtype=str)),
+                                'latitude': ('cell', cells['latitude'].values),
+                                'longitude': ('cell', cells['longitude'].values),
+                                'cell_index': ('cell', cells['cell_index'].values)},
+                        attrs={'regions': regions, 'region_offsets': offsets})
+        #only the coordinates and metadata are written
+        ds.to_zarr(zarr_path, compute=False, consolidated=True, encoding={'vars': {'chunks': zarr_chunks}})
+
+    def compute_region_season(self, region_name, season, state):
+        """
+        Writes a region to its block of cells in the preallocated store of the season and state (see create_season_store).
+        Each write covers whole time chunks and the region's own cells so concurrent workers never touch the same chunk.
+        The days written for the region are recorded in its completion marker in the markers group of the store,
+        a rerun skips the batches whose days are all written so only missing days are read again
+
+        Keyword Arguments
+        region_name: name of the region to process
+        season: season to process
+        state: state to process (region must be a part of the state)
+        """
+        writer = self.region_season_writer(region_name, season, state)
+        if writer is None:
+            return
+
+        dates, add, finish = writer
+        for d in dates:
+            add(self.open_region_day(region_name, season, d))
+        finish()
+
+    def region_season_writer(self, region_name, season, state):
+        """
+        Prepares writing a region to the season store for compute_region_season and compute_state, returns None if all its days are written
+        otherwise (dates, add, finish) like region_writer: dates are the days of the batches which aren't complete and a batch is written
+        as soon as its last day is added so finish() has nothing left to write
+
+        Keyword Arguments
+        region_name: name of the region to process
+        season: season to process
+        state: state to process (region must be a part of the state)
+        """
+        zarr_path = self.season_store_path(season, state)
+        with xr.open_zarr(zarr_path, consolidated=True) as z:
+            if region_name not in z.attrs['regions']:
+                print(' not in store: ' + region_name + ' ' + season + ' ' + state)
+                return None
+            i = z.attrs['regions'].index(region_name)
+            start, stop = z.attrs['region_offsets'][i:i+2]
+            final_vars = z.variable.values
+            if z.variable.dtype.kind in 'iu':
+                final_vars = self.catalog.names(final_vars)
+            date_values_pd = pd.DatetimeIndex(z.time.values)
+            dtype = z.vars.dtype
+            time_chunk = z.vars.encoding['chunks'][1]
+            cells = z.cell_index.values[start:stop] if 'cell_index' in z.coords else None
+
+        #each region has its own marker group as the root attributes are shared by all the workers
+        marker_group = 'markers/' + region_name.replace('/', '_')
+        written = ConvertToZarr.read_days_written(zarr_path, date_values_pd, marker_group)
+        if written is None:
+            written = np.zeros(len(date_values_pd), dtype=bool)
+        elif written.all():
+            print(' already exists: ' + region_name + ' ' + season + ' ' + state)
+            return None
+
+        batch_days = -(-self.batch_days // time_chunk) * time_chunk
+        batches = [a for a in range(0, len(date_values_pd), batch_days) if not written[a:a+batch_days].all()]
+        dates = pd.DatetimeIndex([d for a in batches for d in date_values_pd[a:a+batch_days]])
+        block = None
+        found = False
+        b = 0
+        j = 0
+
+        def add(ds):
+            nonlocal block, found, b, j
+            a = batches[b]
+            days = date_values_pd[a:a+batch_days]
+            if j == 0:
+                block = np.full((len(final_vars), len(days), stop - start), np.nan, dtype=dtype)
+                found = False
+
+            if ds is not None:
+                #reindex so variables missing on this day are NaN, extra ones are dropped
+                ds = ConvertToZarr.stack_cells(ds, cells).to_array().reindex(variable=final_vars)
+                block[:, j, :] = ds.transpose('variable', 'time', 'cell').values[:, 0, :]
+                written[a + j] = True
+                found = True
+
+            j += 1
+            if j == len(days):
+                if found:
+                    xr.Dataset({'vars': (('variable', 'time', 'cell'), block)}).to_zarr(zarr_path,
+                                                                                        region={'time': slice(a, a + len(days)),
+                                                                                                'cell': slice(start, stop)})
+                    ConvertToZarr.write_days_written(zarr_path, date_values_pd, written, marker_group)
+                block = None
+                b += 1
+                j = 0
+            return True
+
+        def finish():
             pass
 
-        #sometimes vars get added, filter to only the list of vars in the first dataset for that region
-        #TODO: handle the case where the first dataset has more vars than subsequent ones
-        final_vars = None
-        for d in date_values_pd:
+        return dates, add, finish
 
-            path =  base_path + '_' + d.strftime('%Y%m%d') + '.nc'
-            print('On ' + str(path.split('/')[-1]))
+    def compute_region_references(self, region_name, season, state):
+        """
+        Writes a reference file for a region and season instead of converting it (fsspec reference spec version 1, like kerchunk).
+        It has the byte range of every variable of every day in the netCDF files laid out as the same vars array as a region store,
+        so PrepML and xr.open_zarr(ReferenceStore(path)) can use it like a region store without any data being copied.
+        Only the HDF5 metadata of the netCDF files is read (with h5py), so the file is rebuilt on every run to pick up new days.
+        The netCDF variables must have the same dtype, chunks and compression on every day and can't be packed (ParseGFS pack)
+        as the scale of packed files differs per day, the references hold absolute paths so the netCDF files can't be moved
 
-            try:
-                ds = xr.open_dataset(path, chunks={'latitude':1, 'longitude':1})
-            except OSError as err:
-                print(' missing file: ' + path)
+        Keyword Arguments
+        region_name: name of the region to process
+        season: season to process
+        state: state to process (region must be a part of the state)
+        """
+        self.compute_references([region_name], season, state)
+
+    def compute_references(self, region_names, season, state):
+        """
+        Writes the reference files of regions of a state and season (see compute_region_references) in one pass over the days,
+        with the 'day' input_layout each Regions_<date>.nc file is opened once for all the regions
+
+        Keyword Arguments
+        region_names: names of the regions to process
+        season: season to process
+        state: state to process (regions must be a part of the state)
+        """
+        #h5py is only needed to build references
+        import h5py
+
+        final_vars = self.catalog_variables(season)
+        regions = {r: {'final_vars': final_vars, 'days': [], 'layout': None, 'refs': {}}
+                   for r in region_names}
+        for d in ConvertToZarr.season_dates(season):
+            paths = {r: self.region_day_path(r, season, d) for r in region_names}
+            #with the 'day' input_layout all the regions share one file
+            for path in dict.fromkeys(path for path, group in paths.values()):
+                if not os.path.exists(path):
+                    continue
+                with h5py.File(path, 'r') as f:
+                    for region_name in region_names:
+                        if paths[region_name][0] == path:
+                            self.add_references(regions[region_name], d, path, paths[region_name][1], f)
+
+        for region_name in region_names:
+            self.write_references(region_name, season, state, regions[region_name])
+
+    @staticmethod
+    def add_references(region, d, path, group, f):
+        """
+        Adds the chunk references of a day of a region to the reference state of compute_references
+
+        Keyword Arguments
+        region: dictionary with the final_vars, days, layout and refs of the region so far (and latitude, longitude and level once it has a day)
+        d: the day as a pandas Timestamp
+        path: path of the netCDF file
+        group: group of the region in the file, None for the root
+        f: the netCDF file opened with h5py
+        """
+        g = f if group is None else f.get(group)
+        if g is None:
+            return
+        if len(region['days']) == 0:
+            #the grid and (without the catalog) the variables are taken from the first day like compute_region
+            with xr.open_dataset(path, group=group) as ds:
+                region['latitude'] = ds.latitude.values
+                region['longitude'] = ds.longitude.values
+                if region['final_vars'] is None:
+                    region['final_vars'] = list(ds.data_vars)
+
+        t = len(region['days'])
+        refs = region['refs']
+        for i, v in enumerate(region['final_vars']):
+            if v not in g:
                 continue
+            var = g[v]
+            if 'scale_factor' in var.attrs or var.scaleoffset is not None or var.fletcher32 or var.compression not in [None, 'gzip']:
+                raise ValueError('Can not reference packed or filtered variable ' + v + ' in ' + path)
+            var_layout = (var.dtype.str, var.chunks or var.shape, var.compression, var.shuffle)
+            if region['layout'] is None:
+                region['layout'] = var_layout
+                region['level'] = var.compression_opts
+            elif var_layout != region['layout']:
+                raise ValueError('Variable ' + v + ' in ' + path + ' has a different dtype, chunks or compression than the first day')
 
-            ds = ds.to_array(name='vars').chunk({'time':1, 'latitude':1, 'longitude':1, 'variable':-1}).to_dataset()
+            url = os.path.abspath(path)
+            if var.chunks is None:
+                #contiguous, the whole day is one chunk unless it was never written
+                if var.id.get_offset() is not None:
+                    refs['vars/' + str(i) + '.' + str(t) + '.0.0'] = [url, var.id.get_offset(), var.id.get_storage_size()]
+            else:
+                for k in range(var.id.get_num_chunks()):
+                    info = var.id.get_chunk_info(k)
+                    if info.filter_mask != 0:
+                        raise ValueError('Can not reference partially filtered chunks of ' + v + ' in ' + path)
+                    a, b = info.chunk_offset[1] // var.chunks[1], info.chunk_offset[2] // var.chunks[2]
+                    refs['vars/' + str(i) + '.' + str(t) + '.' + str(a) + '.' + str(b)] = [url, info.byte_offset, info.size]
+        region['days'].append(d)
 
-            try:
+    def write_references(self, region_name, season, state, region):
+        """
+        Writes the reference file of a region from the reference state built by add_references
 
-                if first:
-                    final_vars = list(ds.variable.values)
-                    ds.to_zarr(zarr_path, consolidated=True)
-                    first=False
-                else:
-                    assert(final_vars is not None)
-                    ds = ds.sel(variable=ds.variable.isin(final_vars))
-                    ds.to_zarr(zarr_path, consolidated=True, append_dim='time')
-            except ValueError as err:
-                print('Value Error ' + format(err) + ' on ' + zarr_path )
-                return
+        Keyword Arguments
+        region_name: name of the region
+        season: season of the region
+        state: state of the region
+        region: the reference state of the region from add_references
+        """
+        ref_path = self.zarr_base_path + season + '/' + state + '/Region_' + region_name + '.json'
+        final_vars = region['final_vars']
+        days = region['days']
+        layout = region['layout']
+        refs = region['refs']
+        if len(days) == 0:
+            print(' no data for: ' + region_name + ' ' + season + ' ' + state)
+            return
+        latitude = region['latitude']
+        longitude = region['longitude']
+        level = region.get('level')
+        if layout is None:
+            layout = ('<f8', (1, len(latitude), len(longitude)), None, False)
+
+        dtype, chunks, compression, shuffle = layout
+        times = pd.DatetimeIndex(days)
+        metadata = {'.zgroup': {'zarr_format': 2}, '.zattrs': {},
+                    'vars/.zarray': {'chunks': [1, 1, chunks[1], chunks[2]],
+                                     'compressor': None if compression is None else {'id': 'zlib', 'level': level},
+                                     'dtype': dtype,
+                                     'fill_value': 'NaN' if np.dtype(dtype).kind == 'f' else None,
+                                     'filters': [{'id': 'shuffle', 'elementsize': np.dtype(dtype).itemsize}] if shuffle else None,
+                                     'order': 'C',
+                                     'shape': [len(final_vars), len(days), len(latitude), len(longitude)],
+                                     'zarr_format': 2},
+                    'vars/.zattrs': {'_ARRAY_DIMENSIONS': ['variable', 'time', 'latitude', 'longitude']}}
+        #the coordinates are small so they are stored inline
+        for name, values, attrs in [('variable', np.array(final_vars), {}),
+                                    ('time', (times - times[0]).days.values.astype('int64'),
+                                     {'units': 'days since ' + str(times[0]), 'calendar': 'proleptic_gregorian'}),
+                                    ('latitude', latitude, {}),
+                                    ('longitude', longitude, {})]:
+            metadata[name + '/.zarray'] = {'chunks': [len(values)], 'compressor': None, 'dtype': values.dtype.str,
+                                           'fill_value': None, 'filters': None, 'order': 'C',
+                                           'shape': [len(values)], 'zarr_format': 2}
+            metadata[name + '/.zattrs'] = {'_ARRAY_DIMENSIONS': [name], **attrs}
+            refs[name + '/0'] = 'base64:' + base64.b64encode(values.tobytes()).decode()
+
+        refs.update({k: json.dumps(v) for k, v in metadata.items()})
+        refs['.zmetadata'] = json.dumps({'metadata': metadata, 'zarr_consolidated_format': 1})
+
+        if not os.path.exists(os.path.dirname(ref_path)):
+            os.makedirs(os.path.dirname(ref_path))
+        tmp_path = ref_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'refs': refs}, f)
+        os.replace(tmp_path, ref_path)
+
+    @staticmethod
+    def resolve_chunks(chunks):
+        """
+        Returns the chunk dictionary for a CHUNK_PRESETS name or dictionary, missing dimensions default to the legacy preset
+
+        Keyword Arguments
+        chunks: name of a CHUNK_PRESETS entry or a dictionary of dimension to chunk size
+        """
+        if isinstance(chunks, str):
+            chunks = ConvertToZarr.CHUNK_PRESETS[chunks]
+        return {**ConvertToZarr.CHUNK_PRESETS['legacy'], **chunks}
+
+    @staticmethod
+    def append_region_day(ds, zarr_path, final_vars=None, chunks='legacy', dtype=None, consolidated=True, catalog=None):
+        """
+        Writes one or more days of a region to its zarr store, creating the store if final_vars is None
+        otherwise appending along time filtered to final_vars
+        Shared by compute_region and the fused ParseGFS.gfs_to_zarr_local pipeline
+
+        returns the list of variables in the store
+
+        Keyword Arguments
+        ds: the filtered dataset for the region and day(s)
+        zarr_path: path of the region zarr store
+        final_vars: variables of the existing store or None to create it (default None)
+        chunks: name of a CHUNK_PRESETS entry or a dictionary of dimension to chunk size, only used when creating the store (default 'legacy')
+        dtype: dtype to store vars as, None keeps the dtype of ds (default None)
+        consolidated: consolidate the metadata after the write, when batching writes call zarr.consolidate_metadata once at the end instead (default True)
+        catalog: VariableCatalog to write the variable coordinate as ids of, final_vars and the return value stay names (default None)
+        """
+        chunks = ConvertToZarr.resolve_chunks(chunks)
+        if dtype is not None:
+            ds = ds.astype(dtype)
+        ds = ds.to_array(name='vars')
+        ds = ds.chunk({d: c for d, c in chunks.items() if d in ds.dims}).to_dataset()
+        #the per cell coordinates of valid_cells_only stores are small, keep them in a single chunk
+        ds = ds.assign_coords({c: ds[c].variable.compute() for c in ds.coords if c not in ds.dims})
+
+        if final_vars is None:
+            final_vars = list(ds.variable.values)
+            #set the zarr chunks explicitly so they don't depend on how many days the first write has
+            zarr_chunks = tuple(ds.dims[d] if chunks[d] == -1 else chunks[d] for d in ds.vars.dims)
+            if catalog is not None:
+                ds = ds.assign_coords(variable=catalog.ids(final_vars))
+            ds.to_zarr(zarr_path, consolidated=consolidated, encoding={'vars': {'chunks': zarr_chunks}})
+        else:
+            ds = ds.sel(variable=ds.variable.isin(final_vars))
+            if catalog is not None:
+                ds = ds.assign_coords(variable=catalog.ids(ds.variable.values))
+            ds.to_zarr(zarr_path, consolidated=consolidated, append_dim='time')
+        return final_vars
+
+    @staticmethod
+    def insert_region_days(ds, zarr_path, final_vars, catalog=None):
+        """
+        Writes days of a region which fall before the last day in its store (a gap or a backfill), appending along time
+        can only add days after the last one so the store is rewritten with the days merged in time order.
+        Like rechunk_store the new store is written next to the old one, a chunk at a time, and then swapped in.
+        Days which are already in the store are replaced, the store's chunks, compressor and attributes are kept
+
+        Keyword Arguments
+        ds: the filtered dataset for the region and day(s)
+        zarr_path: path of the region zarr store
+        final_vars: variables of the existing store
+        catalog: VariableCatalog to write the variable coordinate as ids of when the store has ids (default None)
+        """
+        zarr_path = zarr_path.rstrip('/')
+        tmp_path = zarr_path + '.insert'
+        old_path = zarr_path + '.old'
+        ConvertToZarr.recover_store(zarr_path)
+
+        with xr.open_zarr(zarr_path) as z:
+            #reindex so the variables line up with the store, ones missing from ds are NaN
+            new = ds.to_array(name='vars').reindex(variable=final_vars).astype(z.vars.dtype)
+            if catalog is not None:
+                new = new.assign_coords(variable=catalog.ids(final_vars))
+            new = new.transpose(*z.vars.dims)
+            old = z.vars.isel(time=~z.time.isin(new.time.values).values)
+            #the grid of the store is kept as is
+            merged = xr.concat([old, new], dim='time', join='override').sortby('time')
+
+            chunks = z.vars.encoding['chunks']
+            compressor = z.vars.encoding.get('compressor')
+            merged = merged.chunk(dict(zip(merged.dims, chunks))).to_dataset()
+            for v in merged.variables.values():
+                v.encoding = {}
+            merged.attrs = dict(z.attrs)
+            merged.to_zarr(tmp_path, consolidated=True, encoding={'vars': {'chunks': chunks, 'compressor': compressor}})
+
+        #swap the new store in, the old one is only removed once the new one is in place
+        os.rename(zarr_path, old_path)
+        os.rename(tmp_path, zarr_path)
+        shutil.rmtree(old_path)
+
+    @staticmethod
+    def recover_store(zarr_path):
+        """
+        Cleans up after a run of rechunk_store or insert_region_days which was interrupted: a store which only exists as <store>.old
+        (the run stopped between the two renames of the swap) is moved back, a left over .old next to the store is removed
+        and so are the unfinished .rechunk, .insert and .tmp copies
+
+        Keyword Arguments
+        zarr_path: path of the region zarr store
+        """
+        zarr_path = zarr_path.rstrip('/')
+        old_path = zarr_path + '.old'
+        if os.path.exists(old_path):
+            if os.path.exists(zarr_path):
+                #the new store was already swapped in
+                shutil.rmtree(old_path)
+            else:
+                print(' restoring ' + zarr_path + ' from ' + old_path)
+                os.rename(old_path, zarr_path)
+        for suffix in ['.rechunk', '.insert', '.tmp']:
+            if os.path.exists(zarr_path + suffix):
+                shutil.rmtree(zarr_path + suffix)
+
+    @staticmethod
+    def rechunk_store(zarr_path, chunks='lookback', dtype=None, compressor='source'):
+        """
+        Rewrites an existing region store with a new chunk layout, dtype and/or compressor without going back to the netCDF files.
+        The vars array is streamed one block of target chunks along latitude at a time so memory stays bounded,
+        the new store is written next to the old one, consolidated and then swapped in
+
+        Keyword Arguments
+        zarr_path: path of the region zarr store
+        chunks: name of a CHUNK_PRESETS entry or a dictionary of dimension to chunk size (default 'lookback')
+        dtype: dtype to store vars as, None keeps the current dtype (default None)
+        compressor: numcodecs compressor for vars, None for no compression, 'source' keeps the current one (default 'source')
+        """
+        zarr_path = zarr_path.rstrip('/')
+        tmp_path = zarr_path + '.rechunk'
+        old_path = zarr_path + '.old'
+        ConvertToZarr.recover_store(zarr_path)
+
+        chunks = ConvertToZarr.resolve_chunks(chunks)
+        source = zarr.open_group(zarr_path, mode='r')
+        source_vars = source['vars']
+        dims = source_vars.attrs['_ARRAY_DIMENSIONS']
+
+        target = zarr.open_group(tmp_path, mode='w')
+        target.attrs.update(source.attrs.asdict())
+        for name in source.array_keys():
+            if name != 'vars':
+                zarr.copy(source[name], target, name)
+
+        target_chunks = tuple(n if chunks[d] == -1 else chunks[d] for d, n in zip(dims, source_vars.shape))
+        target_vars = target.create_dataset('vars', shape=source_vars.shape, chunks=target_chunks,
+                                            dtype=source_vars.dtype if dtype is None else dtype,
+                                            compressor=source_vars.compressor if compressor == 'source' else compressor,
+                                            fill_value=source_vars.fill_value)
+        target_vars.attrs.update(source_vars.attrs.asdict())
+
+        #one row of target chunks along latitude (or cell for valid_cells_only stores) at a time
+        lat_axis = dims.index('latitude' if 'latitude' in dims else 'cell')
+        step = target_chunks[lat_axis]
+        for start in range(0, source_vars.shape[lat_axis], step):
+            block = [slice(None)] * len(dims)
+            block[lat_axis] = slice(start, start + step)
+            target_vars[tuple(block)] = source_vars[tuple(block)]
+
+        zarr.consolidate_metadata(tmp_path)
+
+        #swap the new store in, the old one is only removed once the new one is in place
+        os.rename(zarr_path, old_path)
+        os.rename(tmp_path, zarr_path)
+        shutil.rmtree(old_path)
+
+    def rechunk_region(self, region_name, season, state):
+        """
+        Rechunks an existing region store to the chunks and dtype of this instance
+
+        Keyword Arguments
+        region_name: name of the region to process
+        season: season to process
+        state: state to process (region must be a part of the state)
+        """
+        zarr_path = self.zarr_base_path + season + '/' + state + '/Region_' + region_name + '.zarr'
+        ConvertToZarr.recover_store(zarr_path)
+        if not os.path.exists(zarr_path):
+            print(' missing store: ' + zarr_path)
+            return
+        print('Rechunking ' + region_name + ' ' + season + ' ' + state)
+        ConvertToZarr.rechunk_store(zarr_path, self.chunks, self.dtype, self.compressor)
+
+    def rechunk_local(self, jobs=4):
+        """
+        Rechunks the existing stores for all the seasons and regions in parallel
+        e.g. ConvertToZarr(seasons, regions, data_root, chunks='lookback').rechunk_local()
+
+        Keyword Arguments
+        jobs: number of parallel processs to use (default = 4)
+        """
+        l = self.make_list()
+        Parallel(n_jobs=jobs, backend="multiprocessing")(map(delayed(self.rechunk_region), [t[0] for t in l], [t[1] for t in l], [t[2] for t in l]))
 
     def process_tuple(self, t):
         """
         Entry method to call compute_region with a tuple
-        Basically a helper for executing with joblib parallel
+        Basically a helper for executing with joblib parallel or a multiprocessing pool
+
+        returns the tuple so the caller knows which one finished
+
+        Keyword Arguments
+        t: the tuple containing the region (or a tuple of the regions for compute_state), season and state
+        """
+        if isinstance(t[0], tuple):
+            self.compute_state(list(t[0]), t[1], t[2])
+        elif self.zarr_layout == 'season':
+            self.compute_region_season(t[0], t[1], t[2])
+        elif self.zarr_layout == 'reference':
+            self.compute_region_references(t[0], t[1], t[2])
+        else:
+            self.compute_region(t[0], t[1], t[2])
+        return t
+
+    def estimate_cost(self, region_name, season, state):
+        """
+        Estimates the work left to convert a region, season and state as cells x days x variables.
+        The cells and variables come from the metadata of the first available netCDF file of the region
+        and the days from its completion marker (all the days of the season if there is none)
+
+        Keyword Arguments
+        region_name: name of the region, or a tuple of names to sum the work of the regions compute_state converts together
+        season: season of the region
+        state: state of the region
+        """
+        if isinstance(region_name, tuple):
+            return sum(self.estimate_cost(r, season, state) for r in region_name)
+
+        date_values_pd = ConvertToZarr.season_dates(season)
+        cells = None
+        for d in date_values_pd:
+            path, group = self.region_day_path(region_name, season, d)
+            if not os.path.exists(path):
+                continue
+            try:
+                with xr.open_dataset(path, group=group) as ds:
+                    cells = ds.dims['latitude'] * ds.dims['longitude']
+                    variables = len(ds.data_vars) if self.catalog is None else len(self.catalog)
+                break
+            except (OSError, KeyError):
+                #the region isn't in this day's file
+                continue
+        if cells is None:
+            return 0
+
+        if self.zarr_layout == 'season':
+            written = ConvertToZarr.read_days_written(self.season_store_path(season, state), date_values_pd, 'markers/' + region_name.replace('/', '_'))
+        else:
+            written = ConvertToZarr.read_days_written(self.zarr_base_path + season + '/' + state + '/Region_' + region_name + '.zarr', date_values_pd)
+        days = len(date_values_pd) if written is None else np.count_nonzero(~written)
+        return cells * days * variables
+
+    def schedule(self, l):
+        """
+        Returns the tuples ordered with the most estimated work first (see estimate_cost) so the longest conversions
+        don't start last and leave the other workers idle, and a dictionary of tuple to estimated work
 
         Keyword Arguments
-        t: the tuple containing the region, season and state
+        l: list of (region, season, state) tuples as passed to process_tuple
         """
-        self.compute_region(t[0], t[1], t[2])
+        costs = {t: self.estimate_cost(*t) for t in l}
+        return sorted(l, key=lambda t: costs[t], reverse=True), costs
 
     def make_list(self):
         """
@@ -131,7 +1282,41 @@ class ConvertToZarr:
         return to_process
 
     def convert_local(self, jobs=15):
+        """
+        Converts all the seasons and regions in parallel. The tuples are scheduled largest first by estimate_cost and
+        handed out one at a time to whichever worker is free, so the small regions fill in around the large ones instead
+        of the run ending on a few large stragglers. Progress and the projected completion time are printed as tuples finish
+
+        Keyword Arguments
+        jobs: number of parallel processs to use (default = 15)
+        """
         l = self.make_list()
+        if self.input_layout == 'day':
+            #every region of a state is in the same day files so a worker converts a whole state and season, see compute_state
+            l = [(tuple(self.regions[state]), s, state) for s in self.seasons for state in self.regions.keys()]
+
+        if self.catalog is not None:
+            self.build_catalog()
+
+        if self.zarr_layout == 'season':
+            #the season stores are preallocated up front, the regions are then written into them in parallel
+            for s in self.seasons:
+                for state in self.regions.keys():
+                    self.create_season_store(s, state)
+
+        l, costs = self.schedule(l)
+        total = sum(costs.values())
+        print('Converting ' + str(len(l)) + ' regions with an estimated ' + str(total) + ' cell days x variables of work')
 
         #one state & season takes about 6 hours with 15 cores on my machine
-        Parallel(n_jobs=jobs, backend="multiprocessing")(map(delayed(self.process_tuple), l))
\ No newline at end of file
+        start = time.time()
+        done = 0
+        with Pool(jobs) as pool:
+            for i, t in enumerate(pool.imap_unordered(self.process_tuple, l, chunksize=1)):
+                done += costs[t]
+                name = ', '.join(t[0]) if isinstance(t[0], tuple) else t[0]
+                progress = 'Done ' + str(i + 1) + '/' + str(len(l)) + ' ' + name + ' ' + t[1] + ' ' + t[2]
+                if done > 0 and total > 0:
+                    projected = start + (time.time() - start) * total / done
+                    progress += ', ' + str(round(100 * done / total)) + '% of the work, projected completion ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(projected))
+                print(progress)
\ No newline at end of file
@@ -1,9 +1,10 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: DataPipelineNotebooks/1.ParseGFS.ipynb (unless otherwise specified).
 
-__all__ = ['ParseGFS']
+__all__ = ['DailyAggregator', 'PrefetchPipeline', 'StageManifest', 'ParseGFS']
 
 # Cell
 import xarray as xr
+import dask.array as da
 import matplotlib.pyplot as plt
 import pandas as pd
 import salem
@@ -13,6 +14,249 @@ import datetime
 from joblib import Parallel, delayed
 import os
 import time
+import glob
+import threading
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import zarr
+from .convert_to_zarr import ConvertToZarr, VariableCatalog
+
+# Cell
+class DailyAggregator:
+    """
+    Accumulates running daily min, max, sum and count values for a set of hourly GFS datasets
+    so a day of data can be aggregated while only holding one hour of it in memory
+    """
+
+    def __init__(self):
+        self.time = None
+        self.coords = None
+        self.dims = {}
+        self.mins = {}
+        self.maxs = {}
+        self.sums = {}
+        self.counts = {}
+        self.avg_dtypes = {}
+
+    def update(self, ds):
+        """
+        Add the time steps in ds to the running values
+
+        Keyword arguments:
+        ds: hourly dataset with a time dimension, all variables with a time dimension are aggregated
+        """
+        if ds.dims.get('time', 0) == 0:
+            return
+
+        if self.time is None:
+            #resample labels the day by the start of the day
+            self.time = pd.to_datetime(ds.time.values[0]).floor('D')
+            self.coords = {k: v for k, v in ds.coords.items() if 'time' not in v.dims}
+
+        for k, v in ds.data_vars.items():
+            if 'time' not in v.dims:
+                continue
+            #reduce over the time steps in this dataset first, fmin/fmax ignore nan the same way resample does
+            values = v.transpose('time', ...).values
+            hour_min = np.fmin.reduce(values, axis=0)
+            hour_max = np.fmax.reduce(values, axis=0)
+            not_nan = ~np.isnan(values)
+            hour_count = np.count_nonzero(not_nan, axis=0)
+            hour_sum = np.where(not_nan, values, 0).sum(axis=0, dtype=np.float64)
+
+            if k not in self.mins:
+                #preallocate the accumulators the first time a variable is seen
+                self.dims[k] = v.transpose('time', ...).dims
+                self.mins[k] = hour_min
+                self.maxs[k] = hour_max
+                self.sums[k] = hour_sum
+                self.counts[k] = hour_count
+                self.avg_dtypes[k] = np.true_divide(values[:0], 1).dtype
+            else:
+                np.fmin(self.mins[k], hour_min, out=self.mins[k])
+                np.fmax(self.maxs[k], hour_max, out=self.maxs[k])
+                self.sums[k] += hour_sum
+                self.counts[k] += hour_count
+
+    def to_dataset(self):
+        """
+        Returns the dataset of _min, _max and _avg values for the day (or None if no data was added)
+        """
+        if self.time is None:
+            return None
+
+        min_vars = {}
+        max_vars = {}
+        avg_vars = {}
+        for k in self.mins.keys():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avg = np.where(self.counts[k] > 0, self.sums[k] / self.counts[k], np.nan)
+            min_vars[k + '_min'] = (self.dims[k], self.mins[k][np.newaxis])
+            max_vars[k + '_max'] = (self.dims[k], self.maxs[k][np.newaxis])
+            avg_vars[k + '_avg'] = (self.dims[k], avg.astype(self.avg_dtypes[k])[np.newaxis])
+
+        #keep the same variable order as merging the min, max and avg datasets
+        data_vars = {**min_vars, **max_vars, **avg_vars}
+        coords = dict(self.coords)
+        coords['time'] = [self.time]
+        return xr.Dataset(data_vars, coords=coords)
+
+# Cell
+class PrefetchPipeline:
+    """
+    Thread pool pipeline for I/O bound batch jobs: a pool of reader threads loads the inputs for the next
+    items in to memory while a pool of worker threads processes and writes the ones which are already loaded.
+    At most prefetch loaded items are held in memory at once (including the ones being processed)
+    """
+
+    def __init__(self, readers=2, prefetch=4, workers=2):
+        """
+        Keyword arguments:
+        readers: number of reader threads (default 2)
+        prefetch: maximum number of loaded items waiting or being processed (default 4)
+        workers: number of compute/write threads (default 2)
+        """
+        assert(prefetch >= 1)
+        self.readers = readers
+        self.prefetch = prefetch
+        self.workers = workers
+
+    def map(self, read, process, items):
+        """
+        Runs process(item, read(item)) for each item and returns the results in the order of items
+
+        Keyword arguments:
+        read: function which loads the input for an item
+        process: function which takes the item and its loaded input
+        items: list of items to process
+        """
+        slots = threading.BoundedSemaphore(self.prefetch)
+
+        def process_item(item, loaded):
+            try:
+                return process(item, loaded.result())
+            finally:
+                #also frees the slot when the read failed
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.readers) as read_pool, ThreadPoolExecutor(max_workers=self.workers) as work_pool:
+            results = []
+            for item in items:
+                #slots are taken in item order before each read is submitted, so the earliest items always get them
+                #first and a worker only ever waits on a read which already has its slot
+                slots.acquire()
+                loaded = read_pool.submit(read, item)
+                results.append(work_pool.submit(process_item, item, loaded))
+            return [r.result() for r in results]
+
+# Cell
+class StageManifest:
+    """
+    JSON manifest for one stage of ParseGFS which records for each day the input files (size and
+    modification time), the output files (size, modification time and sha256) and the status,
+    so reruns can skip the days which haven't changed and outputs can be checked without reopening them
+    """
+
+    def __init__(self, path):
+        """
+        Keyword arguments:
+        path: path of the json file, it is loaded if it already exists
+        """
+        self.path = path
+        self.days = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.days = json.load(f)['days']
+
+    @staticmethod
+    def file_info(paths):
+        """
+        Returns a dictionary of path to [size, mtime] for the files which exist
+
+        Keyword arguments:
+        paths: list of file paths
+        """
+        info = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            info[path] = [stat.st_size, stat.st_mtime_ns]
+        return info
+
+    @staticmethod
+    def checksum(path):
+        """
+        Returns the sha256 of a file
+
+        Keyword arguments:
+        path: path of the file
+        """
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def record(self, day, inputs, outputs, status):
+        """
+        Records the result of processing a day, call save to write the manifest
+
+        Keyword arguments:
+        day: the date string (YYYYMMDD)
+        inputs: file_info of the input files
+        outputs: list of output file paths, the ones which exist are recorded with their checksum
+        status: 'done', 'error' or 'missing' (no input files)
+        """
+        recorded = {}
+        for path, (size, mtime) in StageManifest.file_info(outputs).items():
+            recorded[path] = {'size': size, 'mtime': mtime, 'sha256': StageManifest.checksum(path)}
+        self.days[day] = {'status': status, 'inputs': inputs, 'outputs': recorded}
+
+    def is_valid(self, day, verify=False):
+        """
+        True if the day is done and its outputs haven't changed size or modification time since,
+        with verify the checksums are recalculated as well
+
+        Keyword arguments:
+        day: the date string (YYYYMMDD)
+        verify: also check the output checksums (default False)
+        """
+        entry = self.days.get(day)
+        if entry is None or entry['status'] != 'done':
+            return False
+
+        current = StageManifest.file_info(entry['outputs'].keys())
+        for path, output in entry['outputs'].items():
+            if current.get(path) != [output['size'], output['mtime']]:
+                return False
+            if verify and StageManifest.checksum(path) != output['sha256']:
+                return False
+        return True
+
+    def is_current(self, day, inputs):
+        """
+        True if the day was already processed with the same input files and doesn't need to be redone
+
+        Keyword arguments:
+        day: the date string (YYYYMMDD)
+        inputs: file_info of the input files
+        """
+        entry = self.days.get(day)
+        if entry is None or entry['inputs'] != inputs:
+            return False
+        return entry['status'] == 'missing' or self.is_valid(day)
+
+    def save(self):
+        """
+        Writes the manifest, replacing the previous one in one step so it is never left half written
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'days': self.days}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
 # Cell
 class ParseGFS:
@@ -21,18 +265,24 @@ class ParseGFS:
     """
     @staticmethod
     def season_to_snow_start_date(season):
-        if season == '15-16':
-            return '2015-11-01'
-        elif season == '16-17':
-            return '2016-11-01'
-        elif season == '17-18':
-            return '2017-11-01'
-        elif season == '18-19':
-            return '2018-11-01'
-        elif season == '19-20':
-            return '2019-11-01'
-
-    def __init__(self, season, state, data_root, interpolate=1):
+        #seasons are coded by the last two digits of the years they span, e.g. 18-19 starts 2018-11-01
+        return '20' + season[:2] + '-11-01'
+
+    @staticmethod
+    def date_to_season(d):
+        """
+        Returns the season code for a date, dates from August on belong to the season starting that year
+        so out of season dates still map to a season folder
+
+        Keyword arguments:
+        d: anything pandas can convert to a datetime
+        """
+        d = pd.to_datetime(d)
+        start_year = d.year if d.month >= 8 else d.year - 1
+        return str(start_year)[2:] + '-' + str(start_year + 1)[2:]
+
+    def __init__(self, season, state, data_root, interpolate=1, interpolate_regions_only=False, output_layout='region', dates=None,
+                 output_dtype='float32', complevel=0, chunksizes=None, pack=False):
         """Initialize the class
 
         Keyword arguments:
@@ -40,11 +290,29 @@ class ParseGFS:
         state: the name of the state or country we are processing
         data_root: the root path of the data folders which contains the 1.RawWeatherData folder
         interpolate: the degree of interpolation (1x and 4x have been tested, 1x is default)
+        interpolate_regions_only: only interpolate the window around each training region instead of the whole state grid,
+                                  results are the same but it is much cheaper for 4x interpolation (default False)
+        output_layout: 'region' writes a Region_<name>_<date>.nc file per region and day,
+                       'day' writes one Regions_<date>.nc file per day with a group for each region (default 'region')
+        dates: a date or list of dates in the season to process instead of the whole season, any date which
+               maps to the season is allowed including out of season ones (default None)
+        output_dtype: dtype the float variables are written as, None keeps the calculated dtype (default 'float32')
+        complevel: zlib compression level for the written variables, 0 turns compression off (default 0)
+                   the per region grids are small enough that chunk overhead outweighs compression, use it for big grids
+        chunksizes: dictionary of dimension name to netCDF chunk size, dimensions not in it are one chunk (default None)
+        pack: write the float variables as int16 with a per variable scale_factor and add_offset (default False)
         """
         self.season = season
         self.snow_start_date = ParseGFS.season_to_snow_start_date(season)
         self.state = state
         self.interpolate = interpolate
+        self.interpolate_regions_only = interpolate_regions_only
+        assert(output_layout in ['region', 'day'])
+        self.output_layout = output_layout
+        self.output_dtype = output_dtype
+        self.complevel = complevel
+        self.chunksizes = chunksizes
+        self.pack = pack
         self.data_root = data_root
         self.state_path = None
 
@@ -57,6 +325,9 @@ class ParseGFS:
 
         #Path to USAvalancheRegions.geojson in this repo
         self.region_path = '../Data'
+        #training regions and their grid index are loaded once and reused for every day
+        self.training_regions_df = None
+        self.region_index = None
         #path to the gfs netcdf files for input
         self.dataset_path = data_root + '/1.RawWeatherData/gfs/' + season + '/' + self.state_path + '/'
         #output path for the result of the interpolation
@@ -67,19 +338,20 @@ class ParseGFS:
         #input file pattern as we'll read a full winter season in one pass
         self.file_pattern2 = '00.f0[0-2]*.nc'
 
-        p = 181
-        if season in ['15-16', '19-20']:
-            p = 182 #leap years
-
-        self.date_values_pd = pd.date_range(self.snow_start_date, periods=p, freq="D")
+        #the season runs through April 30 (181 days, 182 for leap years)
+        self.date_values_pd = pd.date_range(self.snow_start_date, '20' + season[3:] + '-04-30', freq="D")
+        if dates is not None:
+            self.date_values_pd = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(dates))).normalize().unique().sort_values()
+            assert(all(ParseGFS.date_to_season(d) == season for d in self.date_values_pd))
 
         print(self.dataset_path + ' Is Input Directory')
         print(self.day_path + ' Is output directory and input to filtering')
         print(self.filtered_path + ' Is output directory of filtering')
 
-        #check dates end on April 30 which is the last day we support
-        assert(self.date_values_pd[-1].month == 4)
-        assert(self.date_values_pd[-1].day == 30)
+        #check dates end on April 30 which is the last day we support for a full season
+        if dates is None:
+            assert(self.date_values_pd[-1].month == 4)
+            assert(self.date_values_pd[-1].day == 30)
 
         if not os.path.exists(self.day_path):
             os.makedirs(self.day_path)
@@ -87,99 +359,306 @@ class ParseGFS:
         if not os.path.exists(self.filtered_path):
             os.makedirs(self.filtered_path)
 
+        #per stage manifests so reruns only process new or changed days
+        self.resample_manifest = StageManifest(self.day_path + 'Manifest_' + self.state_path + '.json')
+        self.filter_manifest = StageManifest(self.filtered_path + 'Manifest_' + self.state + '.json')
+
+
+    def day_hours(self, t):
+        """
+        Generator of the hourly datasets for a day, each one is loaded in to memory and limited
+        to the hours which fall on the day
 
-    def resample(self, t):
+        Keyword arguments:
+        t: the pandas datetime to process
+        """
+        files = sorted(glob.glob(self.dataset_path + 'gfs.0p25.' + t + self.file_pattern2))
+
+        #make sure we are just getting the first 24 hours
+        pd_t = pd.to_datetime(t)
+        for f in files:
+            with xr.open_dataset(f) as hour_ds:
+                in_day = (hour_ds.time.dt.day == pd_t.day).values
+                if not in_day.any():
+                    continue
+                yield hour_ds.load().isel(time=in_day)
+
+    def read_hours(self, t):
+        """
+        Reads all the hourly datasets for a day in to memory (reader step of the threading backend)
+
+        Keyword arguments:
+        t: the pandas datetime to process
+        """
+        try:
+            return list(self.day_hours(t))
+        except OSError as err:
+            return []
+
+    def aggregate_day(self, t, hours=None):
         """
         Convert netcdf files which already pivot across levels
         from a full forcecast file which covers many days
         to one which only covers one day in the future
         also changes the data from hourly to daily min, avg, and max values
+        each hourly file is read once and streamed in to a DailyAggregator
+
+        returns the daily dataset or None if the files are missing
 
         Keyword arguments:
         t: the pandas datetime to process
+        hours: the hourly datasets if they have already been read (default None streams them from disk)
         """
+        if hours is None:
+            hours = self.day_hours(t)
 
-        print('On time: ' + str(t) + '\n')
-
+        aggregator = DailyAggregator()
         try:
-            with xr.open_mfdataset(self.dataset_path + 'gfs.0p25.' + t + self.file_pattern2, combine='nested', concat_dim='time', parallel=False) as ds:
-
-                #make sure we are just getting the first 24 hours
-                pd_t = pd.to_datetime(t)
-                ds = ds.where(ds.time.dt.day == pd_t.day, drop=True)
-
-                min_name_dict = {}
-                max_name_dict = {}
-                avg_name_dict = {}
-                #print("Calcualting Variables")
-                for k in ds.data_vars.keys():
-                    min_name_dict[k] = k + '_min'
-                    max_name_dict[k] = k + '_max'
-                    avg_name_dict[k] = k + '_avg'
-
-                #print("Reampling")
-                resampled_ds = ds.resample(time='1d')
-                min_1day = resampled_ds.min().rename(min_name_dict)
-                max_1day= resampled_ds.max().rename(max_name_dict)
-                avg_1day = resampled_ds.mean().rename(avg_name_dict)
-
-                #print("Merging")
-                merged_ds = xr.merge([min_1day, max_1day, avg_1day])
-                try:
-                    file = self.day_path + self.state_path + '_' + t + '.nc'
-                    try:
-                        if os.path.exists(file):
-                            os.remove(file)
-                    except OSError as e:
-                        #can likely ignore
-                        print('had remove error ' + format(e))
-                        time.sleep(1)
-                    merged_ds.to_netcdf(file)
-                    merged_ds.close()
-                except Exception as err:
-                    return self.day_path + self.state_path + '_' + t + '.nc' + ' -- ' + format(err)
-                    merged_ds.close()
+            for hour_ds in hours:
+                aggregator.update(hour_ds)
         except OSError as err:
             print('Missing files for time: ' + t)
+            return None
 
-    @staticmethod
-    def check_resample(dates):
+        merged_ds = aggregator.to_dataset()
+        if merged_ds is None:
+            print('Missing files for time: ' + t)
+        return merged_ds
+
+    def get_encoding(self, ds):
+        """
+        Returns the netCDF encoding for the float variables of ds from the output options
+        (output_dtype, complevel, chunksizes and pack)
+
+        Keyword arguments:
+        ds: the dataset to write
+        """
+        encoding = {}
+        for k, v in ds.data_vars.items():
+            if v.dtype.kind != 'f':
+                continue
+
+            var_encoding = {}
+            if self.complevel > 0:
+                var_encoding['zlib'] = True
+                var_encoding['complevel'] = self.complevel
+            if self.chunksizes is not None:
+                var_encoding['chunksizes'] = tuple(min(self.chunksizes.get(d, n), n) for d, n in zip(v.dims, v.shape))
+
+            if self.pack:
+                #int16 packing, -32768 is left for missing values
+                values = v.values
+                has_values = not np.isnan(values).all()
+                with np.errstate(invalid='ignore'):
+                    vmin = np.nanmin(values) if has_values else 0.0
+                    vmax = np.nanmax(values) if has_values else 0.0
+                scale = (float(vmax) - float(vmin)) / 65534
+                var_encoding['dtype'] = 'int16'
+                var_encoding['scale_factor'] = scale if scale > 0 else 1.0
+                var_encoding['add_offset'] = (float(vmax) + float(vmin)) / 2
+                var_encoding['_FillValue'] = np.int16(-32768)
+            elif self.output_dtype is not None:
+                var_encoding['dtype'] = self.output_dtype
+
+            encoding[k] = var_encoding
+        return encoding
+
+    def write_daily(self, merged_ds, t):
+        """
+        Writes a daily dataset to the 2.GFSDaily folder, returns an error string if it fails
+
+        Keyword arguments:
+        merged_ds: the daily dataset from aggregate_day
+        t: the pandas datetime being processed
+        """
+        try:
+            file = self.day_path + self.state_path + '_' + t + '.nc'
+            try:
+                if os.path.exists(file):
+                    os.remove(file)
+            except OSError as e:
+                #can likely ignore
+                print('had remove error ' + format(e))
+                time.sleep(1)
+            merged_ds.to_netcdf(file, encoding=self.get_encoding(merged_ds))
+            merged_ds.close()
+        except Exception as err:
+            return self.day_path + self.state_path + '_' + t + '.nc' + ' -- ' + format(err)
+
+    def resample(self, t, hours=None):
         """
-        method to check if there are any file open issues with the newly output files
+        Resamples the hourly files for one day in to a daily file (see aggregate_day)
 
         Keyword arguments:
-        date: pandas dates to check
+        t: the pandas datetime to process
+        hours: the hourly datasets if they have already been read (default None)
         """
-        dates_with_errors = []
-        for t in dates.strftime('%Y%m%d'):
+
+        print('On time: ' + str(t) + '\n')
+
+        merged_ds = self.aggregate_day(t, hours)
+        if merged_ds is None:
+            return
+
+        return self.write_daily(merged_ds, t)
+
+    def resample_season(self):
+        """
+        Season mode of resample: opens every day of the season as one lazy time indexed cube
+        and calculates the daily min, max and mean for all days as one reduction over (day, 24h)
+        then writes all the days in one pass
+        A day is only reduced in season mode if the time coordinate of its files has each of its 24 hours once
+        (files can hold more than one time step), the other days fall back to resample.
+        Every day is recorded in the resample manifest
+
+        returns a list of errors (None for no error) in the same format as resample_local
+        """
+        dates = list(self.date_values_pd.strftime('%Y%m%d'))
+        season_files = []
+        for t in dates:
+            season_files += sorted(glob.glob(self.dataset_path + 'gfs.0p25.' + t + self.file_pattern2))
+
+        def tag_cycle_day(ds):
+            #the date of the forecast cycle each time step came from so the steps which
+            #fall on the next day (forecast hours 24+) aren't counted for either day
+            cycle_day = os.path.basename(ds.encoding['source']).split('.')[2][:8]
+            return ds.assign_coords(cycle_day=('time', np.full(ds.dims['time'], cycle_day)))
+
+        full_days = []
+        results = []
+        if len(season_files) > 0:
             try:
-                with xr.open_dataset(day_path + statePath + '_' + t + '.nc') as file:
-                    file.close()
+                with xr.open_mfdataset(season_files, combine='nested', concat_dim='time', parallel=True, preprocess=tag_cycle_day) as ds:
+                    times = pd.DatetimeIndex(ds.time.values)
+                    cycle_days = ds.cycle_day.values
+                    in_day = times.strftime('%Y%m%d') == cycle_days
+                    index = []
+                    for t in dates:
+                        i = np.flatnonzero(in_day & (cycle_days == t))
+                        i = i[np.argsort(times[i])]
+                        if len(i) == 24 and (times[i].hour == np.arange(24)).all():
+                            full_days.append(t)
+                            index.append(i)
+
+                    if len(full_days) > 0:
+                        print('Resampling ' + str(len(full_days)) + ' days in season mode')
+                        #one chunk per day so the reshape and reductions stay chunk aligned
+                        ds = ds.isel(time=np.concatenate(index)).chunk({'time': 24})
+
+                        min_vars = {}
+                        max_vars = {}
+                        avg_vars = {}
+                        for k, v in ds.data_vars.items():
+                            if 'time' not in v.dims:
+                                continue
+                            v = v.transpose('time', ...)
+                            by_day = v.data.reshape((len(full_days), 24) + v.data.shape[1:])
+                            min_vars[k + '_min'] = (v.dims, da.nanmin(by_day, axis=1))
+                            max_vars[k + '_max'] = (v.dims, da.nanmax(by_day, axis=1))
+                            avg_vars[k + '_avg'] = (v.dims, da.nanmean(by_day, axis=1))
+
+                        coords = {k: c for k, c in ds.coords.items() if 'time' not in c.dims}
+                        coords['time'] = pd.to_datetime(full_days, format='%Y%m%d')
+                        daily_ds = xr.Dataset({**min_vars, **max_vars, **avg_vars}, coords=coords)
+
+                        files = [self.day_path + self.state_path + '_' + t + '.nc' for t in full_days]
+                        days = [daily_ds.isel(time=[i]) for i in range(len(full_days))]
+                        #save_mfdataset has no encoding argument so set it on the variables
+                        for day in days:
+                            for k, encoding in self.get_encoding(day).items():
+                                day[k].encoding.update(encoding)
+                        xr.save_mfdataset(days, files)
+            except Exception as err:
+                #the files couldn't be opened together or the season pass failed, every day falls back to resample
+                print('Season mode failed, resampling each day: ' + format(err))
+                full_days = []
+
+        for t in dates:
+            if t in full_days:
+                self.record_resample(t, None)
                 continue
-            except:
-                dates_with_errors.append(t)
-        return dates_with_errors
+            result = self.resample(t)
+            results.append(result)
+            self.record_resample(t, result)
+        self.resample_manifest.save()
+
+        return results
+
+    def resample_inputs(self, t):
+        """
+        Returns the file_info of the hourly files used for a day
+
+        Keyword arguments:
+        t: the date string (YYYYMMDD)
+        """
+        return StageManifest.file_info(sorted(glob.glob(self.dataset_path + 'gfs.0p25.' + t + self.file_pattern2)))
+
+    def record_resample(self, t, result, inputs=None):
+        """
+        Records the result of resample for a day in the resample manifest
 
-    def resample_local(self, jobs=4):
+        Keyword arguments:
+        t: the date string (YYYYMMDD)
+        result: the return value of resample
+        inputs: file_info of the inputs if already known (default None)
+        """
+        if inputs is None:
+            inputs = self.resample_inputs(t)
+        output = self.day_path + self.state_path + '_' + t + '.nc'
+        if result is not None:
+            status = 'error'
+        elif os.path.exists(output):
+            status = 'done'
+        else:
+            status = 'missing'
+        self.resample_manifest.record(t, inputs, [output], status)
+
+    def check_resample(self, dates, verify=False):
+        """
+        method to check if there are any issues with the newly output files
+        uses the resample manifest so the files don't need to be reopened
+
+        returns the dates which aren't done or whose output has changed since it was written
+
+        Keyword arguments:
+        dates: pandas dates to check
+        verify: also recalculate the output checksums (default False)
+        """
+        return [t for t in dates.strftime('%Y%m%d') if not self.resample_manifest.is_valid(t, verify)]
+
+    def resample_local(self, jobs=4, backend='multiprocessing', readers=2, prefetch=4, force=False):
         """
         Executes the resample process on the local machine.
         Process is IO bound so don't overallocate n_jobs
         All-Nan Slice and Divide warnings can be ignored
+        Days which are current in the resample manifest are skipped
 
         Keyword arguments:
-        jobs: number of parallel processs to use (default = 4)
+        jobs: number of parallel processs to use, or worker threads for the threading backend (default = 4)
+        backend: 'multiprocessing' for joblib processes or 'threading' for a PrefetchPipeline (default 'multiprocessing')
+        readers: number of reader threads for the threading backend (default = 2)
+        prefetch: number of days held in memory for the threading backend (default = 4)
+        force: redo every day even if the manifest says it is current (default False)
         """
-        results = Parallel(n_jobs=jobs, backend="multiprocessing")(map(delayed(self.resample), self.date_values_pd.strftime('%Y%m%d')))
+        inputs = {t: self.resample_inputs(t) for t in self.date_values_pd.strftime('%Y%m%d')}
+        dates = [t for t in inputs.keys() if force or not self.resample_manifest.is_current(t, inputs[t])]
+        print('Resampling ' + str(len(dates)) + ' of ' + str(len(inputs)) + ' days, the rest are unchanged')
+
+        if backend == 'threading':
+            results = PrefetchPipeline(readers, prefetch, jobs).map(self.read_hours, self.resample, dates)
+        else:
+            results = Parallel(n_jobs=jobs, backend="multiprocessing")(map(delayed(self.resample), dates))
+
+        for t, r in zip(dates, results):
+            self.record_resample(t, r, inputs[t])
+        self.resample_manifest.save()
 
-        redo = None
-        if not any(results):
+        #get the dates for the files which had errors
+        redo = [t for t, r in zip(dates, results) if r is not None]
+        if len(redo) == 0:
             print('No Errors')
         else:
             print('Errors in some files')
-            #get the dates for the files which had errors
-            redo = [x.split('_')[1].split('.')[0] for x in results if x != None]
-
-        if redo is not None:
             #a bit of a manual process to find and fix any errors which were introduced.
             #i'm not entirely sure why some of these errors are non-deterministic but
             #retrying them fixes them if there are no data corruption issues
@@ -187,28 +666,25 @@ class ParseGFS:
             #sometimes the file is corrupt or locked so you need to make sure its deleted first
 
             #fix any errors
-            redo2 = []
-            for r in redo:
-                b = self.resample(r)
-                if b is not None:
-                    redo2.append(b)
+            for t in redo:
+                self.record_resample(t, self.resample(t))
 
             #another pass to try and fix any file corruption issues
-            redo = self.check_resample(date_values_pd)
-
-            results = Parallel(n_jobs=1, backend="multiprocessing")(map(delayed(self.resample), redo))
+            for t in self.check_resample(pd.to_datetime(redo, format='%Y%m%d')):
+                self.record_resample(t, self.resample(t))
+            self.resample_manifest.save()
 
         return results
 
 
-    def interpolate_and_write(self, t):
+    def get_training_regions(self):
         """
-        interpolate and filter each day
-        don't use dask for this, much faster to process the files in parallel
-
-        Keyword arguments:
-        t: the pandas datetime to process
+        Returns the training regions for the state from USAvalancheRegions.geojson
+        the file is only read the first time this is called
         """
+        if self.training_regions_df is not None:
+            return self.training_regions_df
+
         #Read in all avy region shapes and metadata
         regions_df = gpd.read_file(self.region_path + '/USAvalancheRegions.geojson')
         #filter to just the ones where we have lables for training
@@ -223,59 +699,378 @@ class ParseGFS:
             training_regions_df = training_regions_df[training_regions_df['center']=='Colorado Avalanche Information Center']
 
         training_regions_df.reset_index(drop=True, inplace=True)
+        self.training_regions_df = training_regions_df
+        return self.training_regions_df
+
+    def interpolated_grid(self, ds):
+        """
+        Returns the (latitude, longitude) values of ds after interpolation
+
+        Keyword arguments:
+        ds: the daily dataset to interpolate
+        """
+        new_lon = np.linspace(ds.longitude[0], ds.longitude[-1], ds.dims['longitude'] * self.interpolate)
+        new_lat = np.linspace(ds.latitude[0], ds.latitude[-1], ds.dims['latitude'] * self.interpolate)
+        return new_lat, new_lon
+
+    def build_region_index(self, lat, lon):
+        """
+        Calculates the region of interest mask and bounding slice of each training region on a grid
+        this is the same geometry work salem.subset and salem.roi do but only needs to be done once per grid
+
+        Keyword arguments:
+        lat: latitude values of the (interpolated) grid
+        lon: longitude values of the (interpolated) grid
+
+        returns a dictionary of numpy arrays
+        names: region names
+        bounds: (lat start, lat stop, lon start, lon stop) index of each region, -1 when the region isn't on the grid
+        masks: boolean region of interest mask of each region over the full grid
+        """
+        training_regions_df = self.get_training_regions()
+        grid = xr.Dataset(coords={'latitude': lat, 'longitude': lon}).salem.grid
+
+        names = []
+        bounds = []
+        masks = []
+        for _, row in training_regions_df.iterrows():
+            mask = grid.region_of_interest(geometry=row['geometry']) > 0
+            ids = np.nonzero(mask)
+            if len(ids[0]) == 0:
+                bounds.append([-1, -1, -1, -1])
+            else:
+                bounds.append([np.min(ids[0]), np.max(ids[0]) + 1, np.min(ids[1]), np.max(ids[1]) + 1])
+            names.append(row['name'])
+            masks.append(mask)
+
+        return {'names': np.array(names),
+                'bounds': np.array(bounds, dtype=np.int64).reshape(-1, 4),
+                'masks': np.array(masks, dtype=bool).reshape(-1, len(lat), len(lon)),
+                'latitude': np.asarray(lat),
+                'longitude': np.asarray(lon),
+                'srs': np.array(grid.proj.srs),
+                'source': np.array(self.region_source())}
+
+    def region_source(self):
+        """
+        Returns a string identifying the version of USAvalancheRegions.geojson and the state used to build a region index
+        """
+        stat = os.stat(self.region_path + '/USAvalancheRegions.geojson')
+        return self.state + ' ' + str(stat.st_size) + ' ' + str(stat.st_mtime)
+
+    def get_region_index(self, lat, lon):
+        """
+        Returns the region index for the grid, using the in memory index or the one stored in the
+        filtered path when the grid matches, otherwise it is built and stored for the next run
+
+        Keyword arguments:
+        lat: latitude values of the (interpolated) grid
+        lon: longitude values of the (interpolated) grid
+        """
+        def matches(index):
+            return (np.array_equal(index['latitude'], lat) and
+                    np.array_equal(index['longitude'], lon) and
+                    str(index['source']) == self.region_source())
+
+        if self.region_index is not None and matches(self.region_index):
+            return self.region_index
+
+        path = self.filtered_path + 'RegionIndex_' + self.state + '.npz'
+        if os.path.exists(path):
+            with np.load(path) as f:
+                index = {k: f[k] for k in f.files}
+            if matches(index):
+                self.region_index = index
+                return self.region_index
+
+        print('Building region index for ' + self.state)
+        self.region_index = self.build_region_index(lat, lon)
+        np.savez_compressed(path, **self.region_index)
+        return self.region_index
+
+    def prepare_region_index(self):
+        """
+        Builds or loads the region index from the first available daily file (or raw hourly file
+        when there are no daily files) so it can be shared with the parallel workers instead of
+        each one redoing the geometry work
+        """
+        paths = [self.day_path + self.state_path + '_' + t + '.nc' for t in self.date_values_pd.strftime('%Y%m%d')]
+        paths += sorted(glob.glob(self.dataset_path + 'gfs.0p25.*' + self.file_pattern2))[:1]
+        for path in paths:
+            if os.path.exists(path):
+                with xr.open_dataset(path) as ds:
+                    new_lat, new_lon = self.interpolated_grid(ds)
+                return self.get_region_index(new_lat, new_lon)
+        return None
+
+    def subset_region(self, ds, region_index, i):
+        """
+        Subsets the interpolated dataset to a region using the precomputed region index
+        when interpolated the cells outside the region are also masked out (like salem.roi)
+
+        Keyword arguments:
+        ds: the interpolated dataset on the grid the index was built for
+        region_index: index from get_region_index
+        i: position of the region in the index
+        """
+        y0, y1, x0, x1 = region_index['bounds'][i]
+        if y0 < 0:
+            raise ValueError('Region ' + str(region_index['names'][i]) + ' is not on the grid')
+
+        return self.mask_region(ds.isel(latitude=slice(y0, y1), longitude=slice(x0, x1)), region_index, i)
+
+    def mask_region(self, subset, region_index, i):
+        """
+        Masks out the cells outside the region when interpolating (like salem.roi)
+
+        Keyword arguments:
+        subset: dataset covering exactly the bounding slice of the region
+        region_index: index from get_region_index
+        i: position of the region in the index
+        """
+        if self.interpolate == 1:
+            return subset
+
+        y0, y1, x0, x1 = region_index['bounds'][i]
+        mask = xr.DataArray(region_index['masks'][i, y0:y1, x0:x1],
+                            coords={'latitude': subset.latitude.values, 'longitude': subset.longitude.values},
+                            dims=('latitude', 'longitude'))
+        roi_subset = subset.where(mask)
+        #keep the attributes salem.roi adds
+        srs = str(region_index['srs'])
+        roi_subset.attrs = dict(subset.attrs)
+        roi_subset.attrs['pyproj_srs'] = srs
+        for v in roi_subset.data_vars:
+            roi_subset[v].attrs = dict(subset[v].attrs)
+            roi_subset[v].attrs['pyproj_srs'] = srs
+        return roi_subset
+
+    def source_window(self, start, stop, size, halo=1):
+        """
+        Returns the slice of the source grid needed to interpolate the points start:stop of the interpolated grid
+
+        Keyword arguments:
+        start: first index on the interpolated grid
+        stop: index after the last one on the interpolated grid
+        size: number of points along the dimension of the source grid
+        halo: extra source points to include on each side (default 1)
+        """
+        if size * self.interpolate == 1:
+            return slice(0, size)
+        #interpolated grid is a linspace between the first and last source points
+        scale = (size - 1) / (size * self.interpolate - 1)
+        lo = int(np.floor(start * scale)) - halo
+        hi = int(np.ceil((stop - 1) * scale)) + 1 + halo
+        return slice(max(lo, 0), min(hi, size))
+
+    def interpolate_region(self, ds, new_lat, new_lon, region_index, i):
+        """
+        Interpolates just the window of ds which covers a region, plus a halo so edge values match
+        interpolating the full grid, and masks it like subset_region
+
+        Keyword arguments:
+        ds: the daily (not yet interpolated) dataset
+        new_lat: latitude values of the full interpolated grid
+        new_lon: longitude values of the full interpolated grid
+        region_index: index from get_region_index
+        i: position of the region in the index
+        """
+        y0, y1, x0, x1 = region_index['bounds'][i]
+        if y0 < 0:
+            raise ValueError('Region ' + str(region_index['names'][i]) + ' is not on the grid')
+
+        window = ds.isel(latitude=self.source_window(y0, y1, ds.dims['latitude']),
+                         longitude=self.source_window(x0, x1, ds.dims['longitude']))
+        interpolated = window.interp(latitude=new_lat[y0:y1], longitude=new_lon[x0:x1])
+        return self.mask_region(interpolated, region_index, i)
+
+    def open_filtered(self, region_name, date):
+        """
+        Opens the filtered output for a region and day in whichever layout this instance writes
+
+        Keyword arguments:
+        region_name: name of the region
+        date: the date string (YYYYMMDD)
+        """
+        if self.output_layout == 'day':
+            return xr.open_dataset(self.filtered_path + 'Regions_' + date + '.nc', group=ConvertToZarr.region_group(region_name))
+        return xr.open_dataset(self.filtered_path + 'Region_' + region_name + '_' + date + '.nc')
+
+    def filter_regions(self, tmp_ds):
+        """
+        Interpolates a day and subsets it to each of the training regions
+
+        returns a list of (region name, dataset) and a list of errors
+
+        Keyword arguments:
+        tmp_ds: the daily dataset
+        """
+        new_lat, new_lon = self.interpolated_grid(tmp_ds)
+        if self.interpolate_regions_only:
+            region_index = self.get_region_index(new_lat, new_lon)
+        else:
+            interpolated_ds = tmp_ds.interp(latitude=new_lat, longitude=new_lon)
+            region_index = self.get_region_index(interpolated_ds.latitude.values, interpolated_ds.longitude.values)
+
+        subsets = []
+        errors = []
+        for i, name in enumerate(region_index['names']):
+            #print("Calculating region: " + name)
+            try:
+                if self.interpolate_regions_only:
+                    tmp_subset = self.interpolate_region(tmp_ds, new_lat, new_lon, region_index, i)
+                else:
+                    tmp_subset = self.subset_region(interpolated_ds, region_index, i)
+            except ValueError:
+                errors.append('Value Error: Ensure the correct training regions have been provided')
+
+                continue
+            subsets.append((name, tmp_subset))
+
+        return subsets, errors
+
+    def write_filtered(self, subsets, date):
+        """
+        Writes the region subsets for a day to the 3.GFSFiltered folder in the output layout
+
+        returns (errors, redo_date) in the same format as interpolate_and_write
+
+        Keyword arguments:
+        subsets: list of (region name, dataset) from filter_regions
+        date: the date string (YYYYMMDD)
+        """
+        errors = []
+        redo_date = []
+        day_file = self.filtered_path + 'Regions_' + date + '.nc'
+        mode = 'w'
+        for name, tmp_subset in subsets:
+            f = self.filtered_path + 'Region_' + name + '_' + date + '.nc'
+            if self.output_layout == 'day':
+                try:
+                    tmp_subset.to_netcdf(day_file, mode=mode, group=ConvertToZarr.region_group(name), encoding=self.get_encoding(tmp_subset))
+                    mode = 'a'
+                except Exception as err:
+                    #a partial day file is no use, remove it and redo the whole day
+                    if os.path.exists(day_file):
+                        os.remove(day_file)
+                    errors.append(day_file + ' -- ' + format(err))
+                    redo_date.append(date)
+                    break
+                continue
+
+            try:
+                tmp_subset.to_netcdf(f, encoding=self.get_encoding(tmp_subset))
+            except Exception as err:
+                os.remove(f)
+                errors.append(f + ' -- ' + format(err))
+                redo_date.append(date)
+                continue
+
+        return (errors, redo_date)
+
+    def read_daily(self, t):
+        """
+        Reads the daily file for a day in to memory (reader step of the threading backend)
+        returns None if it is missing
+
+        Keyword arguments:
+        t: the pandas datetime to process
+        """
+        try:
+            with xr.open_dataset(self.day_path + self.state_path + '_' + t + '.nc') as tmp_ds:
+                return tmp_ds.load()
+        except OSError as err:
+            print('Missing files for time: ' + t + 'with error ' + format(err))
+            return None
+
+    def interpolate_and_write(self, t, tmp_ds=None):
+        """
+        interpolate and filter each day
+        don't use dask for this, much faster to process the files in parallel
+
+        Keyword arguments:
+        t: the pandas datetime to process
+        tmp_ds: the daily dataset if it has already been read (default None)
+        """
+        if tmp_ds is not None:
+            print('On time: ' + str(t))
+            date = tmp_ds.time.dt.strftime('%Y%m%d').values[0]
+            subsets, errors = self.filter_regions(tmp_ds)
+            write_errors, redo_date = self.write_filtered(subsets, date)
+            return (errors + write_errors, redo_date)
+
         #open files which were previously resampled to a single day per file
         try:
             with xr.open_dataset(self.day_path + self.state_path + '_' + t + '.nc') as tmp_ds:
-                print('On time: ' + str(t))
-
-                new_lon = np.linspace(tmp_ds.longitude[0], tmp_ds.longitude[-1], tmp_ds.dims['longitude'] * self.interpolate)
-                new_lat = np.linspace(tmp_ds.latitude[0], tmp_ds.latitude[-1], tmp_ds.dims['latitude'] * self.interpolate)
-                interpolated_ds = tmp_ds.interp(latitude=new_lat, longitude=new_lon)
-
-                subsets = []
-                filenames = []
-                errors = []
-                redo_date = []
-                date = tmp_ds.time.dt.strftime('%Y%m%d').values[0]
-                for _, row in training_regions_df.iterrows():
-                    #print("Calculating region: " + row['name'])
-                    f = self.filtered_path + 'Region_' + row['name'] + '_' + date + '.nc'
-                    try:
-                        if self.interpolate == 1:
-                            tmp_subset = interpolated_ds.salem.subset(geometry=row['geometry'])
-                        else:
-                            tmp_subset = interpolated_ds.salem.subset(geometry=row['geometry']).salem.roi(geometry=row['geometry'])
-                    except ValueError:
-                        errors.append('Value Error: Ensure the correct training regions have been provided')
-
-                        continue
-
-                    try:
-                        tmp_subset.to_netcdf(f)
-                    except Exception as err:
-                        os.remove(f)
-                        errors.append(f + ' -- ' + format(err))
-                        redo_date.append(date)
-                        continue
+                return self.interpolate_and_write(t, tmp_ds)
         except OSError as err:
             print('Missing files for time: ' + t + 'with error ' + format(err))
             return None
 
-        return (errors, redo_date)
+    def filter_inputs(self, t):
+        """
+        Returns the file_info of the inputs to interpolate_and_write for a day (the daily file and the region shapes)
 
-    def interpolate_and_write_local(self, jobs=6):
+        Keyword arguments:
+        t: the date string (YYYYMMDD)
+        """
+        return StageManifest.file_info([self.day_path + self.state_path + '_' + t + '.nc',
+                                        self.region_path + '/USAvalancheRegions.geojson'])
+
+    def filter_outputs(self, t):
+        """
+        Returns the paths interpolate_and_write writes for a day in the output layout
+
+        Keyword arguments:
+        t: the date string (YYYYMMDD)
+        """
+        if self.output_layout == 'day':
+            return [self.filtered_path + 'Regions_' + t + '.nc']
+        return [self.filtered_path + 'Region_' + name + '_' + t + '.nc' for name in self.get_training_regions()['name']]
+
+    def interpolate_and_write_local(self, jobs=6, backend='multiprocessing', readers=2, prefetch=4, force=False):
         """
         Executes the interpolate and write process on the local machine.
         Process is IO bound so don't overallocate n_jobs
+        Days which are current in the filter manifest are skipped
 
         Keyword arguments:
-        jobs: number of parallel processs to use (default = 6)
+        jobs: number of parallel processs to use, or worker threads for the threading backend (default = 6)
+        backend: 'multiprocessing' for joblib processes or 'threading' for a PrefetchPipeline (default 'multiprocessing')
+        readers: number of reader threads for the threading backend (default = 2)
+        prefetch: number of days held in memory for the threading backend (default = 4)
+        force: redo every day even if the manifest says it is current (default False)
         """
 
-        results = Parallel(n_jobs=6, backend="multiprocessing")(map(delayed(self.interpolate_and_write), self.date_values_pd.strftime('%Y%m%d')))
+        inputs = {t: self.filter_inputs(t) for t in self.date_values_pd.strftime('%Y%m%d')}
+        dates = [t for t in inputs.keys() if force or not self.filter_manifest.is_current(t, inputs[t])]
+        print('Filtering ' + str(len(dates)) + ' of ' + str(len(inputs)) + ' days, the rest are unchanged')
+
+        #do the region geometry work once up front rather than in every job
+        if len(dates) > 0:
+            self.prepare_region_index()
+        if backend == 'threading':
+            #missing days come back as None from read_daily so skip them rather than re-reading
+            process = lambda t, tmp_ds: None if tmp_ds is None else self.interpolate_and_write(t, tmp_ds)
+            results = PrefetchPipeline(readers, prefetch, jobs).map(self.read_daily, process, dates)
+        else:
+            results = Parallel(n_jobs=jobs, backend="multiprocessing")(map(delayed(self.interpolate_and_write), dates))
+
+        for t, x in zip(dates, results):
+            if x is None:
+                status = 'missing'
+            elif x[0] == [] and x[1] == []:
+                status = 'done'
+            else:
+                status = 'error'
+            self.filter_manifest.record(t, inputs[t], self.filter_outputs(t), status)
+        self.filter_manifest.save()
 
         all_none = True
         for x in results:
+            if x is None:
+                #missing day, already reported
+                continue
             if x[0] == [] and x[1] == []:
                 continue
             else:
@@ -287,4 +1082,194 @@ class ParseGFS:
         else:
             print('errors in some files, redo those by calling interpolate_and_write on those specific files')
 
-        return results
\ No newline at end of file
+        return results
+
+    def process_day(self, t, debug=False):
+        """
+        Aggregates, interpolates and subsets one day in memory for gfs_to_zarr_local
+
+        returns (t, list of (region name, dataset), errors)
+
+        Keyword arguments:
+        t: the pandas datetime to process
+        debug: also write the intermediate 2.GFSDaily and 3.GFSFiltered files (default False)
+        """
+        print('On time: ' + str(t))
+
+        merged_ds = self.aggregate_day(t)
+        if merged_ds is None:
+            return (t, [], ['Missing files for time: ' + t])
+
+        errors = []
+        if debug:
+            err = self.write_daily(merged_ds, t)
+            if err is not None:
+                errors.append(err)
+
+        subsets, region_errors = self.filter_regions(merged_ds)
+        errors += region_errors
+        if debug:
+            errors += self.write_filtered(subsets, t)[0]
+
+        #match the dtype the staged pipeline would read back from the netCDF files
+        if self.output_dtype is not None:
+            subsets = [(name, s.astype(self.output_dtype)) for name, s in subsets]
+
+        return (t, [(name, s.load()) for name, s in subsets], errors)
+
+    def gfs_to_zarr_local(self, jobs=4, debug=False, chunks='legacy', batch_days=30):
+        """
+        Fused pipeline which goes straight from the raw hourly gfs files to the per region zarr stores
+        (what resample_local, interpolate_and_write_local and ConvertToZarr do in three passes)
+        Days are aggregated, interpolated and subset in parallel in batches of jobs days, the subsets are buffered per region
+        and written batch_days at a time, rounded up to whole time chunks of the store, so a partial chunk isn't rewritten for every batch.
+        The days in each store come from its completion marker (see ConvertToZarr.days_in_store) so a rerun only processes days which
+        are missing from a store: days after its last day are appended and days before it (gaps or backfills) are kept until the end
+        and inserted with one ConvertToZarr.insert_region_days per store, as each insert rewrites the store. The marker is updated after every write.
+        Stores written with ConvertToZarr variable_ids are decoded with the VariableCatalog.json of the zarr folder
+
+        returns a list of errors
+
+        Keyword arguments:
+        jobs: number of parallel processs to use (default = 4)
+        debug: also write the intermediate 2.GFSDaily and 3.GFSFiltered files (default False)
+        chunks: ConvertToZarr chunk preset or dictionary used when a store is created (default 'legacy')
+        batch_days: number of days buffered per region for each write (default 30)
+        """
+        zarr_base_path = self.data_root + '4.GFSFiltered' + str(self.interpolate) + 'xInterpolationZarr/'
+        zarr_path = zarr_base_path + self.season + '/' + self.state + '/'
+        if not os.path.exists(zarr_path):
+            os.makedirs(zarr_path)
+
+        #do the region geometry work once up front rather than in every job
+        region_index = self.prepare_region_index()
+        if region_index is None:
+            print('No gfs files found in ' + self.dataset_path)
+            return []
+
+        #the days, variables and time chunk of the existing stores, regions which aren't on the grid never get a store
+        season_days = ConvertToZarr.season_dates(self.season)
+        names = [name for name, bounds in zip(region_index['names'], region_index['bounds']) if bounds[0] >= 0]
+        store_days = {}
+        final_vars = {}
+        catalogs = {}
+        time_chunk = {}
+        catalog = None
+        for name in names:
+            path = zarr_path + 'Region_' + name + '.zarr'
+            store_days[name] = pd.DatetimeIndex([])
+            time_chunk[name] = ConvertToZarr.resolve_chunks(chunks)['time']
+            if os.path.exists(path):
+                store_days[name] = ConvertToZarr.days_in_store(path, season_days)
+                group = zarr.open_group(path, mode='r')
+                final_vars[name] = list(group['variable'][:])
+                if group['variable'].dtype.kind in 'iu':
+                    #the variable coordinate holds catalog ids, the days are matched to the store by name
+                    if catalog is None:
+                        if not os.path.exists(zarr_base_path + 'VariableCatalog.json'):
+                            raise ValueError(path + ' has variable ids but there is no ' + zarr_base_path + 'VariableCatalog.json')
+                        catalog = VariableCatalog(zarr_base_path + 'VariableCatalog.json')
+                    final_vars[name] = catalog.names(final_vars[name])
+                    catalogs[name] = catalog
+                time_chunk[name] = group['vars'].chunks[group['vars'].attrs['_ARRAY_DIMENSIONS'].index('time')]
+
+        dates = list(self.date_values_pd.strftime('%Y%m%d'))
+        todo = [t for t in dates if any(pd.Timestamp(t) not in store_days[name] for name in names)]
+        if len(todo) < len(dates):
+            print('Skipping ' + str(len(dates) - len(todo)) + ' days which are already in the stores')
+        if len(todo) == 0:
+            print('No new days to process')
+            return []
+
+        errors = []
+        written = set()
+        pending = {name: [] for name in names}
+        gaps = {name: [] for name in names}
+        store_end = {name: store_days[name].max() for name in names if len(store_days[name]) > 0}
+
+        def batch_size(name):
+            if time_chunk[name] == -1:
+                return len(season_days)
+            return -(-batch_days // time_chunk[name]) * time_chunk[name]
+
+        def write_pending(name, subsets, insert=False):
+            path = zarr_path + 'Region_' + name + '.zarr'
+            days = pd.DatetimeIndex([subset.time.values[0] for subset in subsets])
+            try:
+                if insert:
+                    ConvertToZarr.insert_region_days(xr.concat(subsets, dim='time'), path, final_vars[name], catalogs.get(name))
+                else:
+                    final_vars[name] = ConvertToZarr.append_region_day(xr.concat(subsets, dim='time'), path, final_vars.get(name),
+                                                                       chunks, consolidated=False, catalog=catalogs.get(name))
+            except ValueError as err:
+                errors.append('Value Error ' + format(err) + ' on ' + path)
+                return
+            #the marker is updated after every write so an interrupted run only redoes the days which weren't written
+            store_days[name] = store_days[name].union(days)
+            ConvertToZarr.write_days_written(path, season_days, season_days.isin(store_days[name]))
+            written.add(path)
+
+        with Parallel(n_jobs=min(jobs, len(todo)), backend="multiprocessing") as parallel:
+            for b in range(0, len(todo), jobs):
+                batch = todo[b:b + jobs]
+                results = parallel(delayed(self.process_day)(t, debug) for t in batch)
+
+                for t, subsets, day_errors in results:
+                    errors += day_errors
+                    for name, subset in subsets:
+                        if name not in pending or pd.Timestamp(t) in store_days[name]:
+                            continue
+                        if name in store_end and pd.Timestamp(t) < store_end[name]:
+                            gaps[name].append(subset)
+                            continue
+                        pending[name].append(subset)
+                        #writes end on a time chunk boundary of the store
+                        if (len(store_days[name]) + len(pending[name])) % batch_size(name) == 0:
+                            write_pending(name, pending[name])
+                            pending[name] = []
+
+        for name in names:
+            if len(pending[name]) > 0:
+                write_pending(name, pending[name])
+            if len(gaps[name]) > 0:
+                write_pending(name, gaps[name], insert=True)
+
+        #metadata is only consolidated once the stores are complete
+        for path in written:
+            zarr.consolidate_metadata(path)
+
+        if len(errors) == 0:
+            print('No Errors')
+        else:
+            print('Errors in some days')
+
+        return errors
+
+    @staticmethod
+    def ingest(dates, state, data_root, interpolate=1, jobs=4, debug=False, chunks='legacy', **kwargs):
+        """
+        Incremental ingest for operational runs, e.g. just the latest 00z gfs cycle.
+        Runs gfs_to_zarr_local for only the given dates (grouped by season) and writes them to the existing
+        per region zarr stores, dates which are already in the stores are skipped and dates before the last day
+        of a store (backfills) are inserted in time order
+
+        returns a list of errors
+
+        Keyword arguments:
+        dates: a date, list of dates or pandas date range to ingest
+        state: the name of the state or country we are processing
+        data_root: the root path of the data folders which contains the 1.RawWeatherData folder
+        interpolate: the degree of interpolation (default 1)
+        jobs: number of parallel processs to use (default = 4)
+        debug: also write the intermediate 2.GFSDaily and 3.GFSFiltered files (default False)
+        chunks: ConvertToZarr chunk preset or dictionary used when a store is created (default 'legacy')
+        kwargs: any other ParseGFS arguments such as interpolate_regions_only
+        """
+        dates = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(dates))).normalize().unique().sort_values()
+        seasons = pd.Series([ParseGFS.date_to_season(d) for d in dates], index=dates)
+
+        errors = []
+        for season in sorted(seasons.unique()):
+            pgfs = ParseGFS(season, state, data_root, interpolate, dates=seasons.index[seasons == season], **kwargs)
+            errors += pgfs.gfs_to_zarr_local(jobs=jobs, debug=debug, chunks=chunks)
+        return errors
\ No newline at end of file
@@ -1,6 +1,6 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: DataPipelineNotebooks/3.PrepMLData.ipynb (unless otherwise specified).
 
-__all__ = ['PrepML']
+__all__ = ['StoreCache', 'StratifiedSampler', 'PrepML']
 
 # Cell
 import xarray as xr
@@ -13,14 +13,173 @@ from functools import partial
 from datetime import datetime
 import datetime
 import os
+from collections import OrderedDict
+import weakref
 
 import pickle
 
+from .convert_to_zarr import VariableCatalog, ReferenceStore, ConvertToZarr
+
+# Cell
+class StoreCache:
+    """
+    Least recently used cache of opened zarr stores. An entry is reopened when the consolidated metadata
+    of its store (.zmetadata, or the file itself for reference files) has changed since it was opened,
+    e.g. after more days were converted or the store was rechunked
+    """
+
+    def __init__(self, capacity=64):
+        """
+        Keyword Arguments
+        capacity: maximum number of opened stores to keep (default 64)
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def version(path):
+        """
+        Returns the modification time and size of the metadata of a store, None if it doesn't exist
+
+        Keyword Arguments
+        path: path of the zarr store or reference file
+        """
+        if os.path.isdir(path):
+            path = path + '/.zmetadata'
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self, key, path, open_store):
+        """
+        Returns the cached dataset for key, calling open_store to open it on a miss
+
+        Keyword Arguments
+        key: the cache key
+        path: path of the zarr store or reference file the dataset is opened from
+        open_store: function without arguments which opens the dataset
+        """
+        version = StoreCache.version(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        ds = open_store()
+        self.entries[key] = (version, ds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return ds
+
+    def clear(self):
+        """
+        Drops all the entries and resets the counters
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Cell
+class StratifiedSampler:
+    """
+    Draws label rows class by class without copying the label frame. Each class keeps a shuffled array of its row
+    positions and a cursor, draws of classes which aren't oversampled consume their rows while oversampled classes
+    cycle through their rows and reshuffle them when they wrap around
+    """
+
+    def __init__(self,
+                 labels,
+                 y_column='Day1DangerAboveTreeline',
+                 label_values=['Low', 'Moderate', 'Considerable', 'High'],
+                 oversample={'Low':True, 'Moderate':False, 'Considerable':False, 'High':True},
+                 random_state=1):
+        """
+        Keyword Arguments
+        labels: the set of labels to draw from
+        y_column: the column in the label set to use as the label (default: Day1DangerAboveTreeline)
+        label_values: possible values for the y label (default: ['Low', 'Moderate', 'Considerable', 'High'])
+        oversample: dictionary defining which labels from the label_values set to apply naive oversampling to (default: {'Low':True, 'Moderate':False, 'Considerable':False, 'High':True})
+        random_state: seed for the shuffles (default: 1)
+        """
+        self.labels = labels
+        self.y_column = y_column
+        self.label_values = label_values
+        self.oversample = oversample
+        self.rng = np.random.RandomState(random_state)
+
+        y = labels[y_column].values
+        self.positions = {l: self.rng.permutation(np.flatnonzero(y == l)) for l in label_values}
+        self.cursors = {l: 0 for l in label_values}
+
+    def available(self, label):
+        """
+        Returns the number of rows which can be drawn for a label
+
+        Keyword Arguments
+        label: one of the label_values
+        """
+        if self.oversample[label]:
+            return len(self.positions[label])
+        return len(self.positions[label]) - self.cursors[label]
+
+    def take(self, label, size):
+        """
+        Draws up to size row positions of a label
+
+        Keyword Arguments
+        label: one of the label_values
+        size: number of rows to draw, limited to the rows available
+        """
+        size = min(size, self.available(label))
+        positions = self.positions[label]
+        start = self.cursors[label]
+        end = start + size
+        #copies as positions is shuffled in place when an oversampled class wraps around
+        if end <= len(positions):
+            self.cursors[label] = end
+            return positions[start:end].copy()
+
+        #only oversampled classes wrap around
+        head = positions[start:].copy()
+        self.rng.shuffle(positions)
+        self.cursors[label] = end - len(positions)
+        return np.concatenate([head, positions[:self.cursors[label]]])
+
+    def lookup(self, positions):
+        """
+        Returns the shuffled label rows for a set of row positions with a new index
+
+        Keyword Arguments
+        positions: row positions returned by take
+        """
+        return self.labels.iloc[self.rng.permutation(positions)].reset_index(drop=True)
+
+    def remaining(self):
+        """
+        Returns the label rows which haven't been consumed in their original order
+        """
+        keep = np.ones(len(self.labels), dtype=bool)
+        for l in self.label_values:
+            if not self.oversample[l]:
+                keep[self.positions[l][:self.cursors[l]]] = False
+        return self.labels[keep]
+
 # Cell
 class PrepML:
 
+    #opened stores are shared by all the instances in a process (and inherited by forked workers),
+    #set PrepML.store_cache = StoreCache(capacity) to change the capacity
+    store_cache = StoreCache()
+
 
-    def __init__(self, data_root, interpolate=1, date_start='2015-11-01', date_end='2020-04-30', date_train_test_cutoff='2019-11-01'):
+    def __init__(self, data_root, interpolate=1, date_start='2015-11-01', date_end='2020-04-30', date_train_test_cutoff='2019-11-01', zarr_layout='region', valid_cells_only=False, input_layout='region'):
         """
         Initialize the class
 
@@ -30,12 +189,22 @@ class PrepML:
         date_start: Earlist date to include in label set (default: '2015-11-01')
         date_end: Latest date to include in label set (default: '2020-04-30')
         date_train_test_cutoff: Date to use as a cutoff between the train and test labels (default: '2019-11-01')
+        zarr_layout: zarr_layout used in ConvertToZarr, 'region' for a store per region, 'season' for a single store per season and state
+                     or 'reference' for a reference file per region over the netCDF files (default: 'region')
+        valid_cells_only: True if the stores were written by ConvertToZarr with valid_cells_only, prep_labels then takes the valid lat/lon from the stores (default: False)
+        input_layout: output_layout used in ParseGFS, prep_labels reads the netCDF files of the first day to find the cells with data,
+                      'region' for Region_<name>_<date>.nc files or 'day' for Regions_<date>.nc files with a group per region (default: 'region')
         """
         self.data_root = data_root
         self.interpolation = interpolate
         self.date_start = date_start
         self.date_end = date_end
         self.date_train_test_cutoff = date_train_test_cutoff
+        assert(zarr_layout in ['region', 'season', 'reference'])
+        self.zarr_layout = zarr_layout
+        self.valid_cells_only = valid_cells_only
+        assert(input_layout in ['region', 'day'])
+        self.input_layout = input_layout
         self.nc_path = data_root + '/3.GFSFiltered'+ str(self.interpolation) + 'xInterpolation/'
         self.processed_path = data_root + '/4.GFSFiltered'+ str(self.interpolation) + 'xInterpolationZarr/'
         self.path_to_labels = data_root + 'CleanedForecastsNWAC_CAIC_UAC.V1.2013-2020.csv'
@@ -46,6 +215,13 @@ class PrepML:
         if not os.path.exists(self.ml_path):
             os.makedirs(self.ml_path)
 
+        #variable catalog written by ConvertToZarr with variable_catalog=True
+        self.catalog = None
+        if os.path.exists(self.processed_path + 'VariableCatalog.json'):
+            self.catalog = VariableCatalog(self.processed_path + 'VariableCatalog.json')
+        #whether the variables of an opened store are in catalog order, see catalog_aligned
+        self.aligned_stores = {}
+
         #map states to regions for purposes of data lookup
         self.regions = {
             'Utah': ['Abajos', 'Logan', 'Moab', 'Ogden', 'Provo',
@@ -184,14 +360,10 @@ class PrepML:
         nc_date = np.datetime64(self.date_start)
         nc_season = PrepML.date_to_season(nc_date)[1]
 
-        #maintaining this as a dict since the arrays are ragged and its more efficient this way
-        #storing one sample for each region to get the lat/lon layout
         region_zones = []
-        region_data = {}
         for region in self.regions.keys():
             for r in self.regions[region]:
                 region_zones.append(r)
-                region_data[r] = xr.open_dataset(self.nc_path + nc_season + '/Region_' + r + '_' + pd.to_datetime(nc_date).strftime('%Y%m%d') + '.nc')
 
         #Read in all the label data
         self.labels = pd.read_csv(self.path_to_labels, low_memory=False,
@@ -247,23 +419,41 @@ class PrepML:
         lat_lon_path = self.processed_path + 'lat_lon_union.csv'
         if overwrite_cache or not os.path.exists(lat_lon_path):
             #find union of all lat/lon/region to just grids with values
-            #the process to filter the lat/lon is expensive but we need to do it here (1-5 seconds per region)
             #as the helps the batch process select relevant data
-            for r in region_data.keys():
+            #one sample for each region is opened to get the lat/lon layout
+            nc_day = pd.to_datetime(nc_date).strftime('%Y%m%d')
+            day_regions = None
+            for r in dict.fromkeys(region_zones):
                 print(r)
-                region_df = region_data[r].stack(lat_lon = ('latitude', 'longitude')).lat_lon.to_dataframe()
-                tmp_df = pd.DataFrame.from_records(region_df['lat_lon'], columns=['latitude', 'longitude'])
-                indexes_to_drop = []
-                for index, row in tmp_df.iterrows():
-                    #TODO: there might be a more efficient way than doing this one by one?
-                    if 0 == np.count_nonzero(region_data[r].to_array().sel(latitude=row['latitude'], longitude=row['longitude']).stack(time_var = ('time', 'variable')).dropna(dim='time_var', how='all').values):
-                        indexes_to_drop.append(index)
-                tmp_df.drop(indexes_to_drop, axis=0, inplace=True)
+                if self.valid_cells_only:
+                    #only the cells with data are stored so there is nothing to scan, their lat/lon are all that is needed
+                    region_data = self.open_region_zarr(r, nc_season, unstack=False)
+                    tmp_df = pd.DataFrame({'latitude': region_data.latitude.values, 'longitude': region_data.longitude.values})
+                else:
+                    if self.zarr_layout == 'season':
+                        #the season store already has every region so there is no need to open a netCDF file per region
+                        region_data = self.open_region_zarr(r, nc_season).vars.sel(time=[nc_date]).load().to_dataset(dim='variable')
+                    elif self.input_layout == 'day':
+                        #all the regions are groups of one file which is only opened once
+                        if day_regions is None:
+                            day_regions = ConvertToZarr.open_day_regions(self.nc_path + nc_season + '/Regions_' + nc_day + '.nc')
+                        region_data = day_regions[ConvertToZarr.region_group(r)]
+                    else:
+                        region_data = xr.open_dataset(self.nc_path + nc_season + '/Region_' + r + '_' + nc_day + '.nc')
+                    #a cell is kept if any of its values over all the times and variables is neither NaN nor 0,
+                    #reduced in one pass to a lat/lon mask, the index is the position of the cell in the lat/lon grid
+                    da = region_data.to_array()
+                    valid = (da.fillna(0) != 0).any(dim=['variable', 'time']).transpose('latitude', 'longitude').values
+                    lats, lons = np.meshgrid(da.latitude.values, da.longitude.values, indexing='ij')
+                    tmp_df = pd.DataFrame({'latitude': lats[valid], 'longitude': lons[valid]}, index=np.flatnonzero(valid))
                 tmp_df[self.region_col] = r
                 lat_lon_union = pd.concat([lat_lon_union, tmp_df])
+            if day_regions is not None:
+                for ds in day_regions.values():
+                    ds.close()
 
-                #cache the data
-                lat_lon_union.to_csv(lat_lon_path)
+            #cache the data
+            lat_lon_union.to_csv(lat_lon_path)
         else:
             #load the cached data
             lat_lon_union = pd.read_csv(lat_lon_path,float_precision='round_trip')
@@ -321,6 +511,92 @@ class PrepML:
         assert(len(labels_trends)==len(self.labels))
         self.labels = labels_trends
 
+    def open_region_zarr(self, region, season, unstack=True):
+        """
+        Opens the zarr data of a region and season with the dims (variable, time, latitude, longitude) for any zarr_layout
+
+        Keyword Arguments
+        region: the region to open
+        season: the season to open
+        unstack: False returns season and valid_cells_only stores with their (variable, time, cell) dims (default: True)
+
+        the opened data is kept in PrepML.store_cache so repeated calls don't read the store metadata again
+        """
+        state = self.get_state_for_region(region)
+
+        if self.zarr_layout == 'season':
+            path = self.processed_path + '/' + season + '/' + state + '.zarr'
+        elif self.zarr_layout == 'reference':
+            path = self.processed_path + '/' + season + '/' + state + '/Region_' + region + '.json'
+        else:
+            path = self.processed_path + '/' + season + '/' + state + '/Region_' + region + '.zarr'
+
+        def open_store():
+            if self.zarr_layout == 'season':
+                #the season store is opened once and shared by its regions, each region is a contiguous block of cells
+                tmp_ds = PrepML.store_cache.get((self.processed_path, self.zarr_layout, state, season), path,
+                                                lambda: xr.open_zarr(path, consolidated=True))
+                i = tmp_ds.attrs['regions'].index(region)
+                start, stop = tmp_ds.attrs['region_offsets'][i:i+2]
+                tmp_ds = tmp_ds.isel(cell=slice(start, stop))
+            elif self.zarr_layout == 'reference':
+                #virtual store with the same layout as a region store which reads straight from the netCDF files,
+                #it has a chunk per variable and day so it is opened without dask to only pay for the chunks which are read
+                tmp_ds = xr.open_zarr(ReferenceStore(path), consolidated=True, chunks=None)
+            else:
+                tmp_ds = xr.open_zarr(path, consolidated=True)
+
+            if unstack and 'cell' in tmp_ds.dims:
+                #back to the latitude/longitude grid, cells which aren't stored are NaN and never read
+                tmp_ds = tmp_ds.reset_coords([c for c in ['region', 'cell_index'] if c in tmp_ds.coords], drop=True)
+                tmp_ds = tmp_ds.set_index(cell=['latitude', 'longitude']).unstack('cell')
+            return tmp_ds
+
+        #the processed path and layout are part of the key as the cache is shared by all instances
+        key = (self.processed_path, self.zarr_layout, state, season, region, unstack)
+        return PrepML.store_cache.get(key, path, open_store)
+
+    def catalog_aligned(self, index):
+        """
+        True if the variables are the first variables of the catalog, like stores written with it as new variables are only appended to it.
+        The result is kept for each variable index so the names of a cached store are only compared once
+
+        Keyword Arguments
+        index: the pandas index of the variable coordinate of an opened store
+        """
+        if self.catalog is None or len(index) > len(self.catalog):
+            return False
+        entry = self.aligned_stores.get(id(index))
+        #the weak reference tells a new index which reuses the id of a freed one apart, the catalog can also be replaced or grow
+        if entry is None or entry[0]() is not index or entry[1] is not self.catalog or entry[2] != len(self.catalog):
+            if len(self.aligned_stores) >= PrepML.store_cache.capacity:
+                self.aligned_stores = {k: e for k, e in self.aligned_stores.items() if e[0]() is not None}
+            entry = (weakref.ref(index), self.catalog, len(self.catalog), list(index) == self.catalog.variables[:len(index)])
+            self.aligned_stores[id(index)] = entry
+        return entry[3]
+
+    def select_variables(self, ds, variables):
+        """
+        Filters ds to the variables keeping the order of ds, for stores written in VariableCatalog order
+        this is a positional selection by id instead of comparing all the names
+        and for integer coded stores (ConvertToZarr variable_ids) a lookup of the ids
+
+        Keyword Arguments
+        ds: dataset with a variable dimension
+        variables: list of variable names (or ids for integer coded stores) to keep
+        """
+        if ds.variable.dtype.kind in 'iu':
+            ids = np.asarray(variables)
+            if ids.dtype.kind not in 'iu':
+                ids = self.catalog.ids([v for v in variables if v in self.catalog])
+            return ds.sel(variable=np.intersect1d(ids, ds.indexes['variable']))
+
+        n = ds.sizes['variable']
+        if self.catalog_aligned(ds.indexes['variable']):
+            ids = [i for i in self.catalog.ids([v for v in variables if v in self.catalog]) if i < n]
+            return ds.isel(variable=np.sort(ids))
+        return ds.sel(variable=ds.variable.isin(variables))
+
     def get_data_zarr(self, region, lat, lon, lookback_days, date, variables=None):
         """
         utility to get data for a specific point
@@ -334,18 +610,14 @@ class PrepML:
         variables: filter to just these variables (default: None indicates return all variables)
         """
         #print(region + ' ' + str(lat) + ', ' + str(lon) + ' ' + str(date))
-        state = self.get_state_for_region(region)
         earliest_data, season = PrepML.date_to_season(date)
 
-        path = self.processed_path + '/' + season + '/' + state + '/Region_' + region + '.zarr'
-        #print('*Opening file ' + path)
-
-        tmp_ds = xr.open_zarr(path, consolidated=True)
+        tmp_ds = self.open_region_zarr(region, season)
 
         #filter to just the variables we want
         #TODO: this may be more efficient if we use the open_zarr drop to not even read the variables
         if variables is not None:
-            tmp_ds = tmp_ds.sel(variable=tmp_ds.variable.isin(variables))
+            tmp_ds = self.select_variables(tmp_ds, variables)
 
         start_day = date - np.timedelta64(lookback_days-1, 'D')
         #print('start day ' + str(start_day))
@@ -360,9 +632,44 @@ class PrepML:
         tmp_ds = tmp_ds.reset_index(dims_or_levels='time', drop=True).load()
         return tmp_ds
 
+    @staticmethod
+    def gather_windows(da, lats, lons, dates, lookback_days):
+        """
+        Gathers the lookback window of every sample with a single vectorized read, only the chunks holding the
+        windows are read. Days which aren't in the data are NaN
+
+        returns a numpy array with the dims (sample, variable, lookback) where the last day of the window is the sample date
+
+        Keyword Arguments
+        da: data array with the dims variable, time, latitude and longitude (e.g. the vars of open_region_zarr)
+        lats: latitude of each sample, must be in da
+        lons: longitude of each sample, must be in da
+        dates: date of each sample
+        lookback_days: the number of days in each window
+        """
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        windows = dates[:, None] + np.arange(1 - lookback_days, 1)
+        t = da.indexes['time'].get_indexer(windows.ravel().astype('datetime64[ns]')).reshape(windows.shape)
+        lat = da.indexes['latitude'].get_indexer(lats)
+        lon = da.indexes['longitude'].get_indexer(lons)
+        if (lat < 0).any() or (lon < 0).any():
+            raise KeyError('Sample latitude/longitude not in the data')
+
+        missing = t < 0
+        values = da.isel(time=xr.DataArray(np.where(missing, 0, t), dims=['sample', 'lookback']),
+                         latitude=xr.DataArray(lat, dims=['sample']),
+                         longitude=xr.DataArray(lon, dims=['sample'])).transpose('sample', 'variable', 'lookback').values
+        if missing.any():
+            values = values.astype(np.result_type(values.dtype, np.float32))
+            values[np.broadcast_to(missing[:, None, :], values.shape)] = np.nan
+        return values
+
     def get_data_zarr_batch(self, region, season, df, lookback_days, variables=None):
         """
-        utility to get data for a set of points
+        utility to get data for a set of points, all the windows are read at once with gather_windows
+
+        returns a list with one dataset with the dims (sample, variable, time) and the latitude and longitude of each sample
+        (the same data as concatenating the per sample datasets of get_data_zarr)
 
         Keyword Arguments
         region: the region the point exists in
@@ -372,44 +679,19 @@ class PrepML:
         variables: filter to just these variables (default: None indicates return all variables)
         """
 
-        state = self.get_state_for_region(region)
-
-
-        path = self.processed_path + '/' + season + '/' + state + '/Region_' + region + '.zarr'
-        #print('*Opening file ' + path)
-
-        tmp_ds = xr.open_zarr(path, consolidated=True)
-
-        #finds the minimal set of values for the single zarr collection and then appends
-        #the individaul data to results
-        results = []
-
-        lats = df['latitude'].unique()
-        lons = df['longitude'].unique()
-
-        tmp_ds = xr.open_zarr(path, consolidated=True)
-        min_ds = tmp_ds.sel(latitude=lats, longitude=lons)
+        tmp_ds = self.open_region_zarr(region, season)
 
         #filter to just the variables we want
-        #TODO: this may be more efficient if we use the open_zarr drop to not even read the variables
         if variables is not None:
-            min_ds = min_ds.sel(variable=min_ds.variable.isin(variables))
+            tmp_ds = self.select_variables(tmp_ds, variables)
 
-        for d in df.iterrows():
-            d = d[1]
-            date = d['parsed_date']
-            start_day = date - np.timedelta64(lookback_days-1, 'D')
-
-            result_df = min_ds.sel(latitude=d['latitude'], longitude=d['longitude']).sel(time=slice(start_day, date))
-            #print(str(d['latitude']) + ' ' + str(d['longitude']) + ' ' + str(start_day) + ' ' + str(date))
-            #return result_df
-            date_values_pd = pd.date_range(start_day, periods=lookback_days, freq='D')
-            #reindex should fill missing values with NA
-            result_df = result_df.reindex({'time': date_values_pd})
-            result_df = result_df.assign_coords({'sample': date.strftime('%Y%m%d') + ' ' + region}).expand_dims('sample')
-            results.append(result_df.reset_index(dims_or_levels='time', drop=True).load())
-
-        return results
+        values = PrepML.gather_windows(tmp_ds.vars, df['latitude'].values, df['longitude'].values, df['parsed_date'].values, lookback_days)
+        return [xr.Dataset({'vars': (('sample', 'variable', 'time'), values)},
+                           coords={'sample': (df['parsed_date'].dt.strftime('%Y%m%d') + ' ' + region).values,
+                                   'variable': tmp_ds.variable.values,
+                                   'latitude': ('sample', df['latitude'].values),
+                                   'longitude': ('sample', df['longitude'].values)},
+                           attrs=tmp_ds.attrs)]
 
     def process_sample(self, iter_tuple, lookback_days, variables=None):
         """
@@ -457,7 +739,8 @@ class PrepML:
                      oversample={'Low':True, 'Moderate':False, 'Considerable':False, 'High':True},
                      random_state=1,
                      variables = None,
-                     n_jobs=-1):
+                     n_jobs=-1,
+                     as_numpy=False):
         """
         Primary method to take a set of labels and pull the data for it
         the data is large so generally this needs to be done it batches
@@ -465,7 +748,7 @@ class PrepML:
         For a set of labels and a target column from the labels set create the ML data
 
         Keyword Arguments
-        labels: the set of labels we will randomly choose from
+        labels: the set of labels we will randomly choose from, either a dataframe or a StratifiedSampler (which then defines y_column, label_values, oversample and random_state)
         lookback_days: the number of days prior to the date in the label to also return which defines the timeseries (default: 14)
         batch_size: the size of the data batch to return (default: 64)
         y_column: the column in the label set to use as the label (default: Day1DangerAboveTreeline)
@@ -474,9 +757,16 @@ class PrepML:
         random_state: define a state to force datasets to be returned in a reproducable fashion (deafault: 1)
         varaibles: variables to include (default: None which indicates include all variables)
         n_jobs: number of processes to use (default: -1)
+        as_numpy: return X as a numpy array (sample, variable, time) built with assemble_batch instead of a dataset, the variables are in sorted order (default: False)
+
+        Returns: tuple of X, y and the remaining labels (the sampler itself when labels is a StratifiedSampler so it can be passed to the next call)
         """
 
-        labels_data = labels
+        if isinstance(labels, StratifiedSampler):
+            sampler = labels
+        else:
+            sampler = StratifiedSampler(labels, y_column, label_values, oversample, random_state)
+        label_values = sampler.label_values
 
         X = None
         y = None
@@ -497,28 +787,18 @@ class PrepML:
             else:
                 sample_size = batch_size
 
-            batch_lookups = []
+            batch_positions = []
             for l in label_values:
                 print('    on label: ' + l + ' with samplesize: ' + str(int(sample_size/len(label_values))))
-                print('    len: ' + str(len(labels_data[labels_data[y_column]==l])))
-                label_slice = labels_data[labels_data[y_column]==l]
-                size = int(sample_size/len(label_values))
-                #ensure the propose sample is larger than the available values
-                if len(label_slice) < size:
-                    size = len(label_slice)
-
-                if size > 0:
-                    batch_lookups.append(label_slice.sample(size, random_state=random_state))
-
-                    if not oversample[l]:
-                        labels_data = labels_data.drop(batch_lookups[-1].index, axis=0)
-
-
-
-            #sample frac=1 causes the data to be shuffled
-            batch_lookup = pd.concat(batch_lookups).sample(frac=1, random_state=random_state)
+                print('    len: ' + str(sampler.available(l)))
+                #the sampler limits the sample to the available values
+                batch_positions.append(sampler.take(l, int(sample_size/len(label_values))))
+
+            #lookup shuffles the rows
+            batch_lookup = sampler.lookup(np.concatenate(batch_positions))
+            if len(batch_lookup) == 0:
+                raise ValueError('No labels left to fill the batch, have ' + str(num_in_place))
             #print('lookup shape: ' + str(batch_lookup.shape))
-            batch_lookup.reset_index(inplace=True, drop=True)
             print('have n_jobs ' + str(n_jobs))
 
             tuples = batch_lookup[['UnifiedRegion', 'season']].drop_duplicates()
@@ -546,24 +826,62 @@ class PrepML:
             #    if f is None:
             #        print('Still have none in data')
 
+            #with as_numpy the datasets are only collected, assemble_batch copies them once at the end
             if first and len(data) > 0:
-                X = xr.concat(data, dim='sample')
+                X = data if as_numpy else xr.concat(data, dim='sample')
                 y = batch_lookup
                 first = False
             elif not first and len(data) > 0:
-                X_t = xr.concat(data, dim='sample')
-                X = xr.concat([X, X_t], dim='sample')#, coords='all', compat='override')
+                if as_numpy:
+                    X = X + data
+                else:
+                    X_t = xr.concat(data, dim='sample')
+                    X = xr.concat([X, X_t], dim='sample')#, coords='all', compat='override')
                 y = pd.concat([y, batch_lookup], axis=0)
 
             num_in_place = y.shape[0]
 
 
-        X = X.sortby(['sample', 'latitude', 'longitude'])
+        if as_numpy:
+            X = PrepML.assemble_batch(X)
+        else:
+            X = X.sortby(['sample', 'latitude', 'longitude'])
         y['sample'] = y['parsed_date'].dt.strftime('%Y%m%d') + ': ' + y['UnifiedRegion']
         y = y.sort_values(['sample', 'latitude', 'longitude']).reset_index(drop=True)
 
+        if sampler is labels:
+            return X, y, sampler
+        return X, y, sampler.remaining()
 
-        return X, y, labels_data
+    @staticmethod
+    def assemble_batch(data):
+        """
+        Copies the datasets of a batch in to a single preallocated numpy array, each sample is written straight to its
+        position in the sample, latitude, longitude order (the order of sortby(['sample', 'latitude', 'longitude']))
+
+        returns a numpy array with the dims (sample, variable, time) with the variables in sorted order
+
+        Keyword Arguments
+        data: list of datasets with the dims (sample, variable, time) as returned by get_data_zarr_batch
+        """
+        sample = np.concatenate([d.sample.values for d in data])
+        latitude = np.concatenate([d.latitude.values for d in data])
+        longitude = np.concatenate([d.longitude.values for d in data])
+        order = np.lexsort((longitude, latitude, sample))
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+
+        variable = np.sort(data[0].variable.values)
+        X = np.empty((len(order), len(variable), data[0].sizes['time']), dtype=np.result_type(*[d.vars.dtype for d in data]))
+        start = 0
+        for d in data:
+            v = d.indexes['variable'].get_indexer(variable)
+            if (v < 0).any():
+                raise KeyError('Datasets in the batch have different variables')
+            end = start + d.sizes['sample']
+            X[position[start:end]] = d.vars.values[:, v]
+            start = end
+        return X
 
     @staticmethod
     def prepare_batch_simple(X, y):
@@ -575,7 +893,9 @@ class PrepML:
         y: the y dataframe
         """
 
-        X = X.sortby(['sample', 'latitude', 'longitude'])
+        #numpy batches from get_xr_batch are already in this order
+        if not isinstance(X, np.ndarray):
+            X = X.sortby(['sample', 'latitude', 'longitude'])
 
         sample = y.apply(lambda row: '{}: {}'.format(row['parsed_date'], row['UnifiedRegion']), axis=1)
         y['sample'] = sample
@@ -600,16 +920,17 @@ class PrepML:
 
         Returns: remaining labels (labels which weren't used in the dataset creation)
         """
-        remaining_labels = labels
+        #the sampler is built once and carries the remaining labels between batches
+        sampler = StratifiedSampler(labels)
         for i in range(0, total_rows, batch_size):
             print(str(datetime.datetime.now()) + ' On ' + str(i) + ' of ' + str(total_rows))
-            X, y, remaining_labels = self.get_xr_batch(remaining_labels,
-                                                       lookback_days=lookback_days,
-                                                       batch_size=batch_size,
-                                                       n_jobs=n_jobs)
+            X, y, sampler = self.get_xr_batch(sampler,
+                                              lookback_days=lookback_days,
+                                              batch_size=batch_size,
+                                              n_jobs=n_jobs)
             X.to_zarr(self.ml_path + 'X_' + train_or_test + '_' + str(i/batch_size) + '.zarr')
             y.to_parquet(self.ml_path + 'y_' + train_or_test + '_' + str(i/batch_size) + '.parquet')
-        return remaining_labels
+        return sampler.remaining()
 
 
     def cache_batches_np(self,
@@ -641,19 +962,17 @@ class PrepML:
 
         Returns: tuple containing the batch *X,y) and remaining labels (labels which weren't used in the dataset creation)
         """
-        remaining_labels = labels
+        #the sampler is built once and carries the remaining labels between batches
+        sampler = StratifiedSampler(labels, y_column, label_values, oversample)
         Xs = []
         ys = []
         for i in range(0, total_rows, batch_size):
             print(str(datetime.datetime.now()) + ' *On ' + str(i) + ' of ' + str(total_rows))
-            X, y, remaining_labels = self.get_xr_batch(remaining_labels,
-                                                       lookback_days=lookback_days,
-                                                       batch_size=batch_size,
-                                                       y_column=y_column,
-                                                       label_values=label_values,
-                                                       oversample=oversample,
-                                                       variables=variables,
-                                                       n_jobs=n_jobs)
+            X, y, sampler = self.get_xr_batch(sampler,
+                                              lookback_days=lookback_days,
+                                              batch_size=batch_size,
+                                              variables=variables,
+                                              n_jobs=n_jobs)
             Xs.append(X)
             ys.append(y)
 
@@ -661,7 +980,7 @@ class PrepML:
         X = xr.concat(Xs, dim='sample')
         y = pd.concat(ys, axis=0)
 
-        return PrepML.prepare_batch_simple(X, y), remaining_labels
+        return PrepML.prepare_batch_simple(X, y), sampler.remaining()
 
     #TODO: derive lookback_days from the input set
     #TODO: only write out one y file per X file
@@ -714,6 +1033,9 @@ class PrepML:
         # We are going to create a loop to fill in the np.memmap
         start = 0
 
+        #the sampler is built once and carries the remaining labels between batches
+        sampler = StratifiedSampler(remaining_labels, y_column, label_values, oversample)
+
         for i in range(0, num_rows, batch_size):
             print('On ' + str(i) + ' of ' + str(num_rows))
             # You now grab a chunk of your data that fits in memory
@@ -726,41 +1048,38 @@ class PrepML:
             #                                              label_values=label_values,
             #                                              oversample=oversample,
             #                                              n_jobs=n_jobs)
-            X_df, y_df, remaining_labels = self.get_xr_batch(remaining_labels,
-                                                       lookback_days=lookback_days,
-                                                       batch_size=batch_size,
-                                                       y_column=y_column,
-                                                       label_values=label_values,
-                                                       oversample=oversample,
-                                                       variables=variables,
-                                                       n_jobs=n_jobs)
-
+            #the numpy batch has the variables in sorted order so they are the same between train and test sets
+            #(integer coded variables sort in id order)
+            X_np, y_df, sampler = self.get_xr_batch(sampler,
+                                                    lookback_days=lookback_days,
+                                                    batch_size=batch_size,
+                                                    variables=variables,
+                                                    n_jobs=n_jobs,
+                                                    as_numpy=True)
 
-            X_df, y_df = PrepML.prepare_batch_simple(X_df, y_df)
 
-            #need to make sure all the variables are in the same order (there was an issue that they weren't between train and test sets)
-            X_df = X_df.sortby('variable')
+            X_np, y_df = PrepML.prepare_batch_simple(X_np, y_df)
 
             end = start + batch_size
 
             print('start: ' + str(start) + ' end: ' + str(end))
             #print(str(X.shape))
-            print(str(X_df.vars.values.shape))
+            print(str(X_np.shape))
             print(str(batch_size))
             # I now fill a slice of the np.memmap
-            X[start:end] = X_df.vars.values[:batch_size] #sometimes the process will add a few extras, filter them
+            X[start:end] = X_np[:batch_size] #sometimes the process will add a few extras, filter them
 
             #just save y as parquet
             y_df[:batch_size].to_parquet(self.ml_path + '/y_' + train_or_test + '_batch_' + str(batch) + '_' + file_label + '_' + str(i/batch_size) + '.parquet')
             start = end
-            del X_df, y_df
+            del X_np, y_df
 
         #I can now remove the temp file I created
         os.remove(X_temp_fn)
 
         # Once the data is loaded on the np.memmap, I save it as a normal np.array
         np.save(X_fn, X)
-        return remaining_labels, X_fn
+        return sampler.remaining(), X_fn
 
 
     def concat_memapped(self, to_concat_filenames, file_label='', dim_1_size=1131, dim_2_size=180, destination_path=None):
@@ -843,30 +1162,38 @@ class PrepML:
         assert num_test_rows_per_file % batch_size == 0, 'num_test_rows_per_file needs to be a multiple of batch_size'
         assert batch_size <= num_test_rows_per_file, 'num_test_rows_per_file needs to be greater than batch_size'
         #not all seasons have the same # of variables so find the common subset first
-        train_seasons = train['season'].unique()
-        test_seasons = test['season'].unique()
-        #find the common vars for each season
-        #pull one sample of data for each season
-        data = {}
-        for s in train_seasons:
-            label = train[train['season'] == s].sample(n = 1)
-            assert(len(label==1))
-            data[s] = self.get_data_zarr(label.iloc[0]['UnifiedRegion'], label.iloc[0]['latitude'], label.iloc[0]['longitude'], 7, label.iloc[0]['parsed_date'])
-
-        for s in test_seasons:
-            label = test[test['season'] == s].sample(n = 1)
-            assert(len(label==1))
-            data[s] = self.get_data_zarr(label.iloc[0]['UnifiedRegion'], label.iloc[0]['latitude'], label.iloc[0]['longitude'], 7, label.iloc[0]['parsed_date'])
-
-        v = []
-        for d in data.keys():
-            v.append(set(data[d].variable.values))
-        final_vars = list(set.intersection(*v))
+        train_seasons = train_labels['season'].unique()
+        test_seasons = test_labels['season'].unique()
+        seasons = list(set(train_seasons) | set(test_seasons))
+        if self.catalog is not None and all(s in self.catalog.seasons for s in seasons):
+            #the catalog already has the variables available in each season
+            final_vars = self.catalog.common(seasons)
+        else:
+            #find the common vars for each season
+            #pull one sample of data for each season
+            data = {}
+            for s in train_seasons:
+                label = train_labels[train_labels['season'] == s].sample(n = 1)
+                assert(len(label==1))
+                data[s] = self.get_data_zarr(label.iloc[0]['UnifiedRegion'], label.iloc[0]['latitude'], label.iloc[0]['longitude'], 7, label.iloc[0]['parsed_date'])
+
+            for s in test_seasons:
+                label = test_labels[test_labels['season'] == s].sample(n = 1)
+                assert(len(label==1))
+                data[s] = self.get_data_zarr(label.iloc[0]['UnifiedRegion'], label.iloc[0]['latitude'], label.iloc[0]['longitude'], 7, label.iloc[0]['parsed_date'])
+
+            v = []
+            for d in data.keys():
+                v.append(set(data[d].variable.values))
+            final_vars = list(set.intersection(*v))
 
 
         #get a sample so we can dump the feature labels
         X, _, _ = self.get_xr_batch(train_labels, variables=final_vars, lookback_days=7, batch_size=4)
-        pd.Series(X.variable.data).to_csv(self.ml_path + '/FeatureLabels.csv')
+        feature_labels = X.variable.data
+        if X.variable.dtype.kind in 'iu':
+            feature_labels = self.catalog.names(feature_labels)
+        pd.Series(feature_labels).to_csv(self.ml_path + '/FeatureLabels.csv')
 
         filenames = []
 